@@ -0,0 +1,236 @@
+"""
+In-process stand-in for memcached, speaking the text protocol subset used
+by memcached clients of dogpile.cache: get, gets, set, add, replace,
+append, prepend, cas, delete, incr, decr, touch, flush_all, version and
+quit.
+
+Usage:
+
+    with FakeMemcachedServer(latency=0.0002) as server:
+        config['DOGPILE_CACHE_URLS'] = [server.url]
+
+    $ python benchmarks/fake_memcached.py 11211  # serve until Ctrl+C
+"""
+import socketserver
+import sys
+import threading
+from time import sleep, time
+
+
+MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+STORAGE_COMMANDS = frozenset((
+    b'set', b'add', b'replace', b'append', b'prepend', b'cas',
+))
+
+
+class Storage(object):
+    def __init__(self):
+        self._items = dict()
+        self._cas = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _expires_at(exptime):
+        if exptime == 0:
+            return None
+        if exptime < 0:
+            return 0
+        if exptime <= MAX_RELATIVE_EXPTIME:
+            return time() + exptime
+        return exptime
+
+    def _get(self, key):
+        item = self._items.get(key)
+        if item is not None and item[1] is not None and item[1] <= time():
+            del self._items[key]
+            return None
+        return item
+
+    def get(self, keys):
+        with self._lock:
+            return [(key, self._get(key)) for key in keys]
+
+    def store(self, command, key, flags, exptime, data, cas_unique=None):
+        with self._lock:
+            item = self._get(key)
+            if command == b'add' and item is not None:
+                return b'NOT_STORED'
+            if item is None and command in (b'replace', b'append',
+                                            b'prepend'):
+                return b'NOT_STORED'
+            if command == b'cas':
+                if item is None:
+                    return b'NOT_FOUND'
+                if item[3] != cas_unique:
+                    return b'EXISTS'
+            if command == b'append':
+                flags, expires_at, data = item[0], item[1], item[2] + data
+            elif command == b'prepend':
+                flags, expires_at, data = item[0], item[1], data + item[2]
+            else:
+                expires_at = self._expires_at(exptime)
+            self._cas += 1
+            self._items[key] = (flags, expires_at, data, self._cas)
+            return b'STORED'
+
+    def delete(self, key):
+        with self._lock:
+            if self._get(key) is None:
+                return b'NOT_FOUND'
+            del self._items[key]
+            return b'DELETED'
+
+    def incr(self, key, delta):
+        with self._lock:
+            item = self._get(key)
+            if item is None:
+                return b'NOT_FOUND'
+            try:
+                value = max(int(item[2]) + delta, 0) % 2 ** 64
+            except ValueError:
+                return (
+                    b'CLIENT_ERROR cannot increment or decrement '
+                    b'non-numeric value'
+                )
+            data = str(value).encode('ascii')
+            self._cas += 1
+            self._items[key] = (item[0], item[1], data, self._cas)
+            return data
+
+    def touch(self, key, exptime):
+        with self._lock:
+            item = self._get(key)
+            if item is None:
+                return b'NOT_FOUND'
+            self._items[key] = (
+                item[0], self._expires_at(exptime), item[2], item[3],
+            )
+            return b'TOUCHED'
+
+    def flush(self):
+        with self._lock:
+            self._items.clear()
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                self.wfile.write(b'ERROR\r\n')
+                continue
+            if parts[0] == b'quit':
+                return
+            if self.server.latency:
+                sleep(self.server.latency)
+            response = self.dispatch(parts)
+            if response is not None:
+                self.wfile.write(response)
+
+    def dispatch(self, parts):
+        storage = self.server.storage
+        command, args = parts[0], parts[1:]
+        noreply = bool(args) and args[-1] == b'noreply'
+        if noreply:
+            args = args[:-1]
+
+        try:
+            if command in (b'get', b'gets'):
+                chunks = []
+                for key, item in storage.get(args):
+                    if item is None:
+                        continue
+                    flags, _, data, cas_unique = item
+                    header = b'VALUE %s %d %d' % (key, flags, len(data))
+                    if command == b'gets':
+                        header += b' %d' % cas_unique
+                    chunks.append(header + b'\r\n' + data + b'\r\n')
+                chunks.append(b'END\r\n')
+                return b''.join(chunks)
+
+            if command in STORAGE_COMMANDS:
+                key, flags, exptime, size = args[:4]
+                data = self.rfile.read(int(size) + 2)[:-2]
+                cas_unique = int(args[4]) if command == b'cas' else None
+                result = storage.store(
+                    command, key, int(flags), int(exptime), data, cas_unique,
+                )
+            elif command == b'delete':
+                result = storage.delete(args[0])
+            elif command in (b'incr', b'decr'):
+                delta = int(args[1])
+                result = storage.incr(
+                    args[0], delta if command == b'incr' else -delta
+                )
+            elif command == b'touch':
+                result = storage.touch(args[0], int(args[1]))
+            elif command == b'flush_all':
+                storage.flush()
+                result = b'OK'
+            elif command == b'version':
+                result = b'VERSION 1.6.0-fake'
+            elif command == b'stats':
+                result = b'END'
+            else:
+                result = b'ERROR'
+        except (IndexError, ValueError):
+            result = b'CLIENT_ERROR bad command line format'
+
+        if noreply:
+            return None
+        return result + b'\r\n'
+
+
+class FakeMemcachedServer(socketserver.ThreadingTCPServer):
+    """
+    Serves one in-memory storage on `host`:`port` (a free port by default)
+    from a background thread.
+
+    :param latency: Seconds to sleep before answering each command.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        socketserver.ThreadingTCPServer.__init__(
+            self, (host, port), MemcachedHandler,
+        )
+        self.latency = latency
+        self.storage = Storage()
+        self._thread = None
+
+    @property
+    def url(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11211
+    server = FakeMemcachedServer(port=port)
+    print('Serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark for the per-hit overhead of @cache.region().
+
+Compares the old hit path, which rebuilt dogpile's `cache_on_arguments`
+wrapper on every call, with the memoized wrapper used by `DogpileCache`,
+with and without stats instrumentation (DOGPILE_CACHE_STATS). The in-memory
+backend is used so only the extension overhead is measured.
+
+Usage:
+
+    $ python benchmarks/hit_path.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import Flask
+from flask_dogpile_cache import DogpileCache
+
+
+NUMBER = 100000
+
+
+def make_cache(stats):
+    return DogpileCache(Flask(__name__), dict(
+        DOGPILE_CACHE_BACKEND='dogpile.cache.memory',
+        DOGPILE_CACHE_URLS=[],
+        DOGPILE_CACHE_REGIONS=[('hour', 3600, 'dogpile.cache.memory', [])],
+        DOGPILE_CACHE_STATS=stats,
+    ))
+
+
+def main():
+    def func(a):
+        return a
+
+    cache = make_cache(stats=False)
+
+    def rebuilt(a):
+        return cache.get_region_decorator('hour')(func)(a)
+
+    targets = (
+        ('rebuilt', rebuilt),
+        ('memoized', cache.region('hour')(func)),
+        ('stats', make_cache(stats=True).region('hour')(func)),
+    )
+    for name, target in targets:
+        target(1)
+        seconds = min(timeit.repeat(
+            lambda target=target: target(1), number=NUMBER, repeat=5,
+        ))
+        print('%-10s %8.2f us/hit' % (name, seconds / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
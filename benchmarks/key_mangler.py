@@ -0,0 +1,44 @@
+"""
+Benchmark of key manglers: keys per second across key sizes.
+
+Usage:
+
+    $ python benchmarks/key_mangler.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask_dogpile_cache import KeyMangler
+
+
+NUMBER = 50000
+KEY_SIZES = (8, 64, 1024, 16384)
+MANGLERS = (
+    ('md5', KeyMangler()),
+    ('sha1', KeyMangler(algorithm='sha1')),
+    ('blake2b-16', KeyMangler(algorithm='blake2b', digest_size=16)),
+    ('blake2b-16-plain-64', KeyMangler(algorithm='blake2b', digest_size=16,
+                                       max_plain_length=64)),
+)
+
+
+def main():
+    print('%-22s' % 'mangler' + ''.join('%12s' % size for size in KEY_SIZES))
+    for name, mangler in MANGLERS:
+        row = '%-22s' % name
+        for size in KEY_SIZES:
+            key = 'benchmarks.module:func|' + 'x' * size
+            assert len(mangler(key)) <= KeyMangler.MAX_KEY_LENGTH
+            seconds = min(timeit.repeat(
+                lambda: mangler(key), number=NUMBER, repeat=3,
+            ))
+            row += '%12d' % (NUMBER / seconds)
+        print(row)
+    print('(keys per second by args size in chars)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark of region value serializers and compression: encode and decode
+time and bytes stored on cache server.
+
+Usage:
+
+    $ python benchmarks/serializers.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask_dogpile_cache import CompressionProxy, make_serializer
+
+
+NUMBER = 200
+PAYLOAD = [
+    {
+        'id': i,
+        'name': 'user %d' % i,
+        'email': 'user%d@example.com' % i,
+        'tags': ['a', 'b', 'c'],
+        'score': i * 0.5,
+        'active': i % 2 == 0,
+    }
+    for i in range(2000)
+]
+CODECS = (
+    ('pickle-2', 'pickle', 2, None),
+    ('pickle-5', 'pickle', 5, None),
+    ('json', 'json', None, None),
+    ('msgpack', 'msgpack', None, None),
+    ('pickle-5+zlib', 'pickle', 5, 'zlib'),
+    ('pickle-5+lzma', 'pickle', 5, 'lzma'),
+    ('json+zlib', 'json', None, 'zlib'),
+)
+
+
+def main():
+    print('%-16s%12s%12s%12s' % ('codec', 'encode ms', 'decode ms', 'bytes'))
+    for name, serializer_name, protocol, compression in CODECS:
+        try:
+            dumps, loads = make_serializer(serializer_name, protocol)
+        except ValueError as e:
+            print('%-16s skipped: %s' % (name, e))
+            continue
+
+        if compression:
+            proxy = CompressionProxy(compression)
+            encode = lambda value: proxy.compress(dumps(value))
+            decode = lambda data: loads(proxy.decompress(data))
+        else:
+            encode, decode = dumps, loads
+
+        data = encode(PAYLOAD)
+        encode_seconds = min(timeit.repeat(
+            lambda: encode(PAYLOAD), number=NUMBER, repeat=3,
+        ))
+        decode_seconds = min(timeit.repeat(
+            lambda: decode(data), number=NUMBER, repeat=3,
+        ))
+        print('%-16s%12.3f%12.3f%12d' % (
+            name,
+            encode_seconds / NUMBER * 1e3,
+            decode_seconds / NUMBER * 1e3,
+            len(data),
+        ))
+
+
+if __name__ == '__main__':
+    main()
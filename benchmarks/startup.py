@@ -0,0 +1,65 @@
+"""
+Benchmark of application startup: `init_app` time with lazily configured
+regions against configuring every region up front.
+
+Usage:
+
+    $ python benchmarks/startup.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import Flask
+
+from flask_dogpile_cache import DogpileCache
+
+
+NUMBER = 20
+REGIONS_COUNTS = (4, 32, 256)
+
+
+def make_config(regions_count):
+    return dict(
+        DOGPILE_CACHE_BACKEND='dogpile.cache.memory',
+        DOGPILE_CACHE_URLS=['127.0.0.1:11211'],
+        DOGPILE_CACHE_ARGUMENTS={},
+        DOGPILE_CACHE_REGIONS=[
+            ('region_%d' % i, 60 + i) for i in range(regions_count)
+        ],
+    )
+
+
+def lazy(app, config):
+    cache = DogpileCache()
+    cache.init_app(app, dict(config))
+    return cache
+
+
+def eager(app, config):
+    cache = lazy(app, config)
+    cache.get_all_regions()
+    return cache
+
+
+def main():
+    app = Flask(__name__)
+    print('%-10s' % 'mode' + ''.join(
+        '%12s' % count for count in REGIONS_COUNTS
+    ))
+    for name, init in (('lazy', lazy), ('eager', eager)):
+        row = '%-10s' % name
+        for count in REGIONS_COUNTS:
+            config = make_config(count)
+            seconds = min(timeit.repeat(
+                lambda: init(app, config), number=NUMBER, repeat=3,
+            ))
+            row += '%12.1f' % (seconds / NUMBER * 1e6)
+        print(row)
+    print('(init_app microseconds by regions count)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+Load benchmark of functions decorated with @cache.region(), with no outside
+services: values are stored in `dogpile.cache.memory` with injected latency
+or in the in-process fake memcached server (needs a memcached client, e.g.
+python-memcached for 'dogpile.cache.memcached' backend).
+
+Every combination of hit ratio, key size, value size, threads count and
+batch size is run for `--ops` calls per thread. Keys are drawn from a
+seeded random generator, so runs with the same arguments make the same
+calls. Results (calls per second, keys per second, p50 and p99 latency of
+a call in microseconds) are printed as JSON.
+
+Usage:
+
+    $ python benchmarks/suite.py > before.json
+    $ python benchmarks/suite.py --backend dogpile.cache.memcached \\
+        --threads 1,8 --batch-sizes 1,10 --output after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+from importlib.metadata import version
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dogpile.cache import register_backend
+from dogpile.cache.backends.memory import MemoryBackend
+from flask import Flask
+
+from fake_memcached import FakeMemcachedServer
+from flask_dogpile_cache import DogpileCache, __version__
+
+
+KEYSPACE = 1000
+
+
+class LatencyMemoryBackend(MemoryBackend):
+    """
+    `dogpile.cache.memory` sleeping `latency` seconds on every call, like a
+    network round trip would take.
+    """
+
+    def __init__(self, arguments):
+        super(LatencyMemoryBackend, self).__init__(arguments)
+        self.latency = arguments.get('latency', 0)
+
+    def _wait(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def get(self, key):
+        self._wait()
+        return super(LatencyMemoryBackend, self).get(key)
+
+    def get_multi(self, keys):
+        self._wait()
+        return super(LatencyMemoryBackend, self).get_multi(keys)
+
+    def set(self, key, value):
+        self._wait()
+        super(LatencyMemoryBackend, self).set(key, value)
+
+    def set_multi(self, mapping):
+        self._wait()
+        super(LatencyMemoryBackend, self).set_multi(mapping)
+
+    def delete(self, key):
+        self._wait()
+        super(LatencyMemoryBackend, self).delete(key)
+
+
+register_backend('benchmarks.memory', __name__, 'LatencyMemoryBackend')
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def make_cache(options, urls):
+    if options.backend == 'benchmarks.memory':
+        arguments = {'latency': options.latency}
+    else:
+        arguments = {}
+    config = dict(
+        DOGPILE_CACHE_BACKEND=options.backend,
+        DOGPILE_CACHE_URLS=urls,
+        DOGPILE_CACHE_ARGUMENTS=arguments,
+        DOGPILE_CACHE_REGIONS=[('hour', 3600)],
+        DOGPILE_CACHE_STATS=options.stats,
+    )
+    return DogpileCache(Flask(__name__), config)
+
+
+def make_calls(rng, hit_ratio, key_size, batch_size, ops, miss_counter):
+    """
+    Returns a list of `ops` calls, each a list of `batch_size` arguments.
+    Hits are drawn from primed keys, misses are keys never used before.
+    """
+    calls = []
+    for _ in range(ops):
+        batch = []
+        for _ in range(batch_size):
+            if rng.random() < hit_ratio:
+                index = rng.randrange(KEYSPACE)
+            else:
+                index = KEYSPACE + next(miss_counter)
+            batch.append('%0*d' % (key_size, index))
+        calls.append(batch)
+    return calls
+
+
+def run_scenario(options, urls, hit_ratio, key_size, value_size,
+                 threads_count, batch_size):
+    cache = make_cache(options, urls)
+    value = b'v' * value_size
+
+    @cache.region('hour')
+    def func(key):
+        return value
+
+    cache.invalidate_region('hour')
+    for index in range(KEYSPACE):
+        func('%0*d' % (key_size, index))
+
+    rng = random.Random(options.seed)
+    miss_counter = iter(range(10 ** 9))
+    calls_by_thread = [
+        make_calls(rng, hit_ratio, key_size, batch_size, options.ops,
+                   miss_counter)
+        for _ in range(threads_count)
+    ]
+    latencies_by_thread = [[] for _ in range(threads_count)]
+    barrier = threading.Barrier(threads_count + 1)
+
+    def worker(calls, latencies):
+        barrier.wait()
+        for batch in calls:
+            start = perf_counter()
+            if batch_size == 1:
+                func(batch[0])
+            else:
+                cache.get_many(func, [(key,) for key in batch])
+            latencies.append(perf_counter() - start)
+
+    threads = [
+        threading.Thread(target=worker, args=args)
+        for args in zip(calls_by_thread, latencies_by_thread)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = perf_counter() - start
+    cache.shutdown()
+
+    latencies = sorted(
+        latency for latencies in latencies_by_thread for latency in latencies
+    )
+    return dict(
+        hit_ratio=hit_ratio,
+        key_size=key_size,
+        value_size=value_size,
+        threads=threads_count,
+        batch_size=batch_size,
+        calls=len(latencies),
+        seconds=round(seconds, 6),
+        calls_per_second=round(len(latencies) / seconds, 1),
+        keys_per_second=round(len(latencies) * batch_size / seconds, 1),
+        p50_us=round(percentile(latencies, 0.5) * 1e6, 2),
+        p99_us=round(percentile(latencies, 0.99) * 1e6, 2),
+    )
+
+
+def parse_list(cast):
+    return lambda value: [cast(item) for item in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backend', default='benchmarks.memory',
+                        help="'benchmarks.memory' (dogpile.cache.memory with "
+                             "--latency) or a memcached backend of "
+                             "dogpile.cache run against fake memcached")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every backend call')
+    parser.add_argument('--hit-ratios', type=parse_list(float),
+                        default=[1.0, 0.9, 0.5])
+    parser.add_argument('--key-sizes', type=parse_list(int),
+                        default=[8, 200])
+    parser.add_argument('--value-sizes', type=parse_list(int),
+                        default=[100, 10000])
+    parser.add_argument('--threads', type=parse_list(int), default=[1, 8])
+    parser.add_argument('--batch-sizes', type=parse_list(int),
+                        default=[1, 10])
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='calls per thread in every scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-stats', dest='stats', action='store_false',
+                        help='disable DOGPILE_CACHE_STATS')
+    parser.add_argument('--output', help='file to write JSON to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    server = None
+    urls = ['127.0.0.1:11211']
+    if options.backend != 'benchmarks.memory':
+        server = FakeMemcachedServer(latency=options.latency).start()
+        urls = [server.url]
+
+    try:
+        results = [
+            run_scenario(options, urls, hit_ratio, key_size, value_size,
+                         threads_count, batch_size)
+            for hit_ratio in options.hit_ratios
+            for key_size in options.key_sizes
+            for value_size in options.value_sizes
+            for threads_count in options.threads
+            for batch_size in options.batch_sizes
+        ]
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = dict(
+        environment=dict(
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            platform=platform.platform(),
+            flask_dogpile_cache=__version__,
+            dogpile_cache=version('dogpile.cache'),
+            flask=version('flask'),
+        ),
+        options=dict(
+            (name, value) for name, value in sorted(vars(options).items())
+            if name != 'output'
+        ),
+        results=results,
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
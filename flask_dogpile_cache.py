@@ -1,252 +1,3886 @@
-from dogpile.cache import make_region
-from functools import wraps
-from hashlib import md5
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import lzma
+import os
+import pickle
+import random
+import re
+import struct
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import fields, is_dataclass
+import click
+from dogpile.cache import make_region, register_backend
+from dogpile.cache.api import NO_VALUE, CacheBackend, CantDeserializeException
+from dogpile.cache.proxy import ProxyBackend
+from dogpile.cache.region import DefaultInvalidationStrategy
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    g,
+    has_app_context,
+    has_request_context,
+    request,
+)
+from flask.cli import AppGroup
+from flask.globals import request_ctx
+from functools import partial, wraps
+from inspect import Parameter, iscoroutinefunction, signature
+from threading import Lock, local
+from time import perf_counter, sleep, time
+from urllib.request import urlopen
+from uuid import uuid4
+from weakref import WeakSet, finalize, ref
 
 
-__version__ = '0.3.2'
+__version__ = '0.4'
+
+log = logging.getLogger(__name__)
+
+_instances = WeakSet()
+
+
+def _after_fork_in_child():
+    for cache in list(_instances):
+        cache._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class NotCacheableResponse(BaseException):
+    """
+    Raised by creators of views decorated with @cache.cached_view() to skip
+    storing a response. Subclasses BaseException, so it is never taken for
+    a failure of the view (see `stale_if_error` region option).
+    """
+
+    def __init__(self, response, request_object):
+        super(NotCacheableResponse, self).__init__()
+        self.response = response
+        self.request_object = request_object
 
 
 class NotInitialized(object):
     pass
 
 
-class DogpileCache(object):
-    FUNC_REGION_NAME_ATTR = 'dogpile_cache_region_name'
+def _is_session_accessed():
+    """
+    Returns True if the session of current request was accessed, so Flask
+    adds `Vary: Cookie` to the response.
+    """
+    ctx = request_ctx._get_current_object()
+    # Not via `ctx.session`, which marks the session accessed in Flask 3.1.
+    ctx_vars = vars(ctx)
+    request_session = ctx_vars.get('_session', ctx_vars.get('session'))
+    return bool(getattr(request_session, 'accessed', False))
+
+
+def typed_to_str(value):
+    """
+    Converts function argument to str for cache key so that values of
+    different types never collide (`1` and `'1'`).
+
+    Tuples, lists, dicts, sets and dataclasses are converted structurally
+    and independently of dict and set ordering, so keys stay stable across
+    processes. Other objects are converted with `str()`.
+    """
+    if value is None or isinstance(value, (str, bytes, bool, int, float)):
+        return repr(value)
+    if isinstance(value, tuple):
+        return '(%s)' % ','.join(map(typed_to_str, value))
+    if isinstance(value, list):
+        return '[%s]' % ','.join(map(typed_to_str, value))
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(sorted(
+            '%s:%s' % (typed_to_str(k), typed_to_str(v))
+            for k, v in value.items()
+        ))
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(map(typed_to_str, value)))
+    if is_dataclass(value) and not isinstance(value, type):
+        return '%s(%s)' % (type(value).__name__, ','.join(
+            typed_to_str(getattr(value, field.name))
+            for field in fields(value)
+        ))
+    return '%s:%s' % (type(value).__name__, value)
+
+
+def signature_key_generator(namespace, fn, to_str=str):
+    """
+    Function key generator of cache regions.
+
+    Like dogpile's default `function_key_generator`, but binds arguments to
+    `fn` signature, so keyword arguments are supported and `f(1)`,
+    `f(a=1)` and (for `def f(a=1)`) `f()` produce the same key.
+    Signature is inspected once, when `fn` is decorated.
+    """
+    if namespace is None:
+        namespace = '%s:%s' % (fn.__module__, fn.__name__)
+    else:
+        namespace = '%s:%s|%s' % (fn.__module__, fn.__name__, namespace)
+
+    fn_signature = signature(fn)
+    params = list(fn_signature.parameters.values())
+    has_self = bool(params) and params[0].name in ('self', 'cls')
+    positional_count = len([
+        param for param in params
+        if param.kind in (Parameter.POSITIONAL_ONLY,
+                          Parameter.POSITIONAL_OR_KEYWORD)
+    ])
+    has_keyword_only = any(
+        param.kind == Parameter.KEYWORD_ONLY for param in params
+    )
+
+    def generate_key(*args, **kwargs):
+        if kwargs or len(args) != positional_count or has_keyword_only:
+            bound = fn_signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args
+            kwargs = bound.kwargs
+
+        if has_self:
+            args = args[1:]
+
+        key = ' '.join(map(to_str, args))
+        if kwargs:
+            key += ' ' + ' '.join(
+                '%s=%s' % (name, to_str(kwargs[name]))
+                for name in sorted(kwargs)
+            )
+
+        return namespace + '|' + key
+
+    return generate_key
+
+
+class KeyMangler(object):
+    """
+    Key mangler of cache regions.
+
+    Keys generated by `cache_on_arguments` look like `namespace|args`. The
+    args part is replaced with its hex digest, so keys stay short and safe
+    for memcached. Too long namespaces are hashed too (once per namespace).
+
+    :param algorithm: hashlib algorithm name or a callable which accepts
+                      bytes and returns hex digest str. 'md5' by default.
+
+    :param digest_size: Digest size in bytes for algorithms supporting it
+                        (for example, 'blake2b').
+
+    :param max_plain_length: Keys not longer than this and made only of
+                             printable non-space ASCII chars are left as is.
+                             0 by default (all keys are hashed). Must not
+                             exceed `MAX_KEY_LENGTH`.
+
+    Mangled keys are never longer than `MAX_KEY_LENGTH` bytes when encoded
+    to UTF-8.
+    """
+    MAX_KEY_LENGTH = 250
+    _is_plain = re.compile(r'^[\x21-\x7e]*$').match
+
+    def __init__(self, algorithm='md5', digest_size=None, max_plain_length=0):
+        if callable(algorithm):
+            self._hexdigest = algorithm
+        else:
+            try:
+                constructor = getattr(hashlib, algorithm)
+            except (AttributeError, TypeError):
+                raise ValueError('Unknown hash algorithm `%s`' % algorithm)
+            if digest_size is not None:
+                constructor = partial(constructor, digest_size=digest_size)
+            self._hexdigest = lambda data: constructor(data).hexdigest()
+
+        if max_plain_length > self.MAX_KEY_LENGTH:
+            raise ValueError(
+                '`max_plain_length` must not exceed %d' % self.MAX_KEY_LENGTH
+            )
+        self.max_plain_length = max_plain_length
+        # Hashed keys must never match plain ones.
+        self._separator = '#' if max_plain_length else '|'
+        digest_length = len(self._hexdigest(b'').encode('utf-8'))
+        if 2 * digest_length + 1 > self.MAX_KEY_LENGTH:
+            raise ValueError(
+                'Digests longer than %d bytes do not fit in cache keys'
+                % ((self.MAX_KEY_LENGTH - 1) // 2)
+            )
+        self._max_namespace_length = self.MAX_KEY_LENGTH - 1 - digest_length
+        self._namespaces = dict()
+
+    def _mangle_namespace(self, namespace):
+        if len(namespace.encode('utf-8')) > self._max_namespace_length:
+            mangled = self._hexdigest(namespace.encode('utf-8'))
+        else:
+            mangled = namespace
+        self._namespaces[namespace] = mangled
+        return mangled
+
+    def __call__(self, key):
+        if len(key) <= self.max_plain_length and self._is_plain(key):
+            return key
+
+        namespace, separator, args = key.partition('|')
+        if not separator:
+            return self._hexdigest(key.encode('utf-8'))
+
+        try:
+            namespace = self._namespaces[namespace]
+        except KeyError:
+            namespace = self._mangle_namespace(namespace)
+
+        return '%s%s%s' % (
+            namespace,
+            self._separator,
+            self._hexdigest(args.encode('utf-8')),
+        )
+
+
+class MaxAgeInvalidationStrategy(DefaultInvalidationStrategy):
+    """
+    Region invalidation strategy which also treats values older than
+    `max_age` seconds as hard invalidated.
+
+    Used with refresh-ahead and stale-while-revalidate, when region
+    `expiration_time` is shorter than `max_age`: values between the two are
+    served while regenerated in background, older ones are regenerated
+    synchronously.
+
+    :param stale_after: Age in seconds after which served values are
+                        counted as stale by calling `on_stale()`.
+    """
+
+    def __init__(self, max_age=None, stale_after=None, on_stale=None):
+        super(MaxAgeInvalidationStrategy, self).__init__()
+        self.max_age = max_age
+        self.stale_after = stale_after
+        self.on_stale = on_stale
+
+    def is_hard_invalidated(self, timestamp):
+        if super(MaxAgeInvalidationStrategy, self).is_hard_invalidated(
+            timestamp
+        ):
+            return True
+        if self.max_age is None:
+            return False
+
+        age = time() - timestamp
+        if age > self.max_age:
+            return True
+        if self.stale_after is not None and age > self.stale_after:
+            if self.on_stale is not None:
+                self.on_stale()
+        return False
+
+
+class SharedInvalidationStrategy(MaxAgeInvalidationStrategy):
+    """
+    Region invalidation strategy which stores invalidation time in the
+    region backend, so `region.invalidate()` in one process is seen by all
+    processes using the same cache servers.
+
+    Stored invalidation is re-read at most once per `check_interval`
+    seconds, so processes converge within that time.
+
+    `region` must be set to configured region before use.
+    """
+    KEY = 'flask_dogpile_cache:invalidation|%s'
+
+    def __init__(self, region_name, check_interval=1, max_age=None,
+                 stale_after=None, on_stale=None):
+        super(SharedInvalidationStrategy, self).__init__(
+            max_age, stale_after, on_stale
+        )
+        self.key = self.KEY % region_name
+        self.check_interval = check_interval
+        self.region = None
+        self._invalidated_at = None
+        self._hard = None
+        self._checked_at = 0
+
+    def _get_backend_and_key(self):
+        """
+        Returns the region's `CircuitBreakerProxy` if it has one, so errors
+        of a degraded backend aren't raised, else the actual backend. Other
+        proxies (L1 tier, compression) are skipped.
+        """
+        backend = self.region.backend
+        while isinstance(backend, ProxyBackend):
+            if isinstance(backend, CircuitBreakerProxy):
+                break
+            backend = backend.proxied
+        else:
+            backend = self.region.actual_backend
+        key = self.key
+        if self.region.key_mangler:
+            key = self.region.key_mangler(key)
+        return backend, key
+
+    def _check(self):
+        now = time()
+        if now - self._checked_at < self.check_interval:
+            return
+
+        self._checked_at = now
+        backend, key = self._get_backend_and_key()
+        data = backend.get_serialized(key)
+        if isinstance(data, bytes):
+            invalidated_at, _, hard = data.partition(b'|')
+            self._invalidated_at = float(invalidated_at)
+            self._hard = hard == b'1'
+
+    def invalidate(self, hard=True):
+        self._invalidated_at = time()
+        self._hard = bool(hard)
+        self._checked_at = self._invalidated_at
+
+        backend, key = self._get_backend_and_key()
+        backend.set_serialized(key, (
+            '%r|%d' % (self._invalidated_at, self._hard)
+        ).encode('ascii'))
+
+    def is_invalidated(self, timestamp):
+        self._check()
+        return (
+            self._invalidated_at is not None
+            and timestamp < self._invalidated_at
+        )
+
+    def was_hard_invalidated(self):
+        self._check()
+        return self._hard is True
+
+    def was_soft_invalidated(self):
+        self._check()
+        return self._hard is False
+
+
+class RefreshAheadRunner(object):
+    """
+    dogpile's `async_creation_runner` regenerating values on a bounded
+    thread pool.
+
+    dogpile calls it holding the key's mutex, so each key is regenerated by
+    one runner at a time. If `max_pending` regenerations are already queued
+    the mutex is released and the current value is served as is.
+    Regenerations run in the app context of the calling thread, if any.
+
+    :param should_cache_fn: Same as dogpile's `should_cache_fn`, regenerated
+                            values it returns False for aren't stored.
+                            Creators with their own `should_cache_fn`
+                            attribute (see `admission` region option) use it
+                            instead.
+    """
+
+    def __init__(self, workers, max_pending, should_cache_fn=None):
+        self.max_pending = max_pending
+        self.should_cache_fn = should_cache_fn
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = 0
+        self._lock = Lock()
+
+    def __call__(self, cache, key, creator, mutex):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                mutex.release()
+                return
+            self._pending += 1
+
+        # Creators may use current_app, as they do in the request thread.
+        app = current_app._get_current_object() if has_app_context() else None
+
+        # dogpile wraps creators with functools.wraps, which keeps it.
+        should_cache_fn = getattr(
+            creator, 'should_cache_fn', self.should_cache_fn
+        )
+
+        def regenerate():
+            value = creator()
+            if should_cache_fn is None or should_cache_fn(value):
+                cache.set(key, value)
+
+        def run():
+            try:
+                if app is None:
+                    regenerate()
+                else:
+                    with app.app_context():
+                        regenerate()
+            except Exception:
+                log.exception('Refresh-ahead of `%s` failed', key)
+            finally:
+                mutex.release()
+                with self._lock:
+                    self._pending -= 1
+
+        try:
+            self._executor.submit(run)
+        except RuntimeError:
+            # Executor is shut down.
+            mutex.release()
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def _make_deserializer(loads, errors):
+    """
+    Wraps `loads` so `errors` it raises become dogpile's
+    CantDeserializeException, which makes the value a cache miss.
+    """
+    def deserializer(data):
+        try:
+            return loads(data)
+        except errors:
+            raise CantDeserializeException()
+
+    return deserializer
+
+
+def make_serializer(name, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+    """
+    Returns (serializer, deserializer) pair of functions for region values.
+
+    Values 'pickle', 'json' and 'msgpack' deserializers fail to load (e.g.
+    stored with other serializer before the config was changed) are
+    treated as missing.
+
+    :param name: 'pickle', 'json' or 'msgpack' (requires msgpack package),
+                 or an object with `dumps` and `loads` methods working with
+                 bytes.
+
+    :param pickle_protocol: Protocol for 'pickle', highest by default.
+    """
+    if name == 'pickle':
+        # Unpickling arbitrary bytes may raise about any exception.
+        return (
+            partial(pickle.dumps, protocol=pickle_protocol),
+            _make_deserializer(pickle.loads, Exception),
+        )
+    if name == 'json':
+        return (
+            lambda value: json.dumps(value).encode('utf-8'),
+            _make_deserializer(
+                lambda data: json.loads(data.decode('utf-8')), ValueError
+            ),
+        )
+    if name == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError('`msgpack` serializer requires msgpack package')
+        return (
+            partial(msgpack.packb, use_bin_type=True),
+            _make_deserializer(
+                partial(msgpack.unpackb, raw=False),
+                (ValueError, TypeError, msgpack.UnpackException),
+            ),
+        )
+    if hasattr(name, 'dumps') and hasattr(name, 'loads'):
+        return name.dumps, name.loads
+
+    raise ValueError('Unknown serializer `%s`' % name)
+
+
+class CompressionProxy(ProxyBackend):
+    """
+    Compresses serialized region values not shorter than `threshold` bytes.
+
+    Every stored value gets one byte prefix telling how it's compressed.
+    Values which can't be decompressed are treated as missing.
+
+    :param algorithm: 'zlib' or 'lzma'.
+
+    :param threshold: Min size in bytes of values to compress.
+
+    :param level: Compression level (preset for lzma).
+    """
+    PLAIN = b'-'
+    COMPRESSORS = {
+        'zlib': (b'z', zlib.compress, zlib.decompress),
+        'lzma': (
+            b'x',
+            lambda data, level: lzma.compress(data, preset=level),
+            lzma.decompress,
+        ),
+    }
+
+    def __init__(self, algorithm='zlib', threshold=1024, level=6):
+        super(CompressionProxy, self).__init__()
+        if algorithm not in self.COMPRESSORS:
+            raise ValueError('Unknown compression `%s`' % algorithm)
+
+        self._flag, self._compress, _ = self.COMPRESSORS[algorithm]
+        self._decompressors = dict(
+            (flag, decompress)
+            for flag, _, decompress in self.COMPRESSORS.values()
+        )
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, data):
+        if len(data) >= self.threshold:
+            return self._flag + self._compress(data, self.level)
+        return self.PLAIN + data
+
+    def decompress(self, data):
+        if not isinstance(data, bytes) or not data:
+            return NO_VALUE
+
+        flag, data = data[:1], data[1:]
+        if flag == self.PLAIN:
+            return data
+        try:
+            return self._decompressors[flag](data)
+        except Exception:
+            return NO_VALUE
+
+    def get_serialized(self, key):
+        return self.decompress(self.proxied.get_serialized(key))
+
+    def get_serialized_multi(self, keys):
+        return [
+            self.decompress(value)
+            for value in self.proxied.get_serialized_multi(keys)
+        ]
+
+    def set_serialized(self, key, value):
+        self.proxied.set_serialized(key, self.compress(value))
+
+    def set_serialized_multi(self, mapping):
+        self.proxied.set_serialized_multi(dict(
+            (key, self.compress(value)) for key, value in mapping.items()
+        ))
+
+
+class ChunkingProxy(ProxyBackend):
+    """
+    Stores serialized region values longer than `chunk_size` bytes in
+    several keys, so they fit memcached item size limit (1 MB by default).
+
+    Chunks are stored first, then a manifest under the value's key with
+    random token of this write (chunk keys are built from it), chunks
+    count, value length and CRC32. Chunks of all manifests fetched by one
+    get are fetched with one `get_serialized_multi`. A value with missing
+    or mismatched chunks is treated as missing.
+
+    Chunks of overwritten values aren't deleted, they are evicted by cache
+    server (deleted values' chunks are deleted).
+    """
+    PLAIN = b'-'
+    CHUNKED = b'c'
+    MANIFEST = struct.Struct('>8sIQI')
+    CHUNK_KEY = 'flask_dogpile_cache:chunk|%s|%d'
+
+    def __init__(self, chunk_size=1000000):
+        super(ChunkingProxy, self).__init__()
+        if chunk_size < 1:
+            raise ValueError('`chunk_size` must be positive')
+        self.chunk_size = chunk_size
+
+    def _get_chunk_keys(self, token, count):
+        token = token.hex()
+        return [self.CHUNK_KEY % (token, i) for i in range(count)]
+
+    def _parse_manifest(self, data):
+        """
+        :return tuple: (value, None) for not chunked value,
+                       (None, manifest) for chunked one.
+        """
+        if not isinstance(data, bytes) or not data:
+            return NO_VALUE, None
+
+        flag = data[:1]
+        if flag == self.PLAIN:
+            return data[1:], None
+        if flag == self.CHUNKED:
+            try:
+                return None, self.MANIFEST.unpack(data[1:])
+            except struct.error:
+                pass
+        return NO_VALUE, None
+
+    def _join(self, manifest, chunks):
+        _, _, length, crc = manifest
+        if not all(isinstance(chunk, bytes) for chunk in chunks):
+            return NO_VALUE
+        data = b''.join(chunks)
+        if len(data) != length or zlib.crc32(data) != crc:
+            return NO_VALUE
+        return data
+
+    def _split(self, value, chunks, manifests, key):
+        if len(value) <= self.chunk_size:
+            manifests[key] = self.PLAIN + value
+            return
+
+        count = -(-len(value) // self.chunk_size)
+        token = os.urandom(8)
+        view = memoryview(value)
+        for i, chunk_key in enumerate(self._get_chunk_keys(token, count)):
+            chunks[chunk_key] = bytes(
+                view[i * self.chunk_size:(i + 1) * self.chunk_size]
+            )
+        manifests[key] = self.CHUNKED + self.MANIFEST.pack(
+            token, count, len(value), zlib.crc32(value)
+        )
+
+    def get_serialized(self, key):
+        value, manifest = self._parse_manifest(
+            self.proxied.get_serialized(key)
+        )
+        if manifest is None:
+            return value
+        return self._join(manifest, self.proxied.get_serialized_multi(
+            self._get_chunk_keys(manifest[0], manifest[1])
+        ))
+
+    def get_serialized_multi(self, keys):
+        parsed = [
+            self._parse_manifest(data)
+            for data in self.proxied.get_serialized_multi(keys)
+        ]
+        chunk_keys = []
+        for _, manifest in parsed:
+            if manifest is not None:
+                chunk_keys.extend(
+                    self._get_chunk_keys(manifest[0], manifest[1])
+                )
+        if not chunk_keys:
+            return [value for value, _ in parsed]
+
+        chunks = iter(self.proxied.get_serialized_multi(chunk_keys))
+        return [
+            value if manifest is None else self._join(
+                manifest, [next(chunks) for _ in range(manifest[1])]
+            )
+            for value, manifest in parsed
+        ]
+
+    def set_serialized(self, key, value):
+        chunks, manifests = dict(), dict()
+        self._split(value, chunks, manifests, key)
+        if chunks:
+            self.proxied.set_serialized_multi(chunks)
+        self.proxied.set_serialized(key, manifests[key])
+
+    def set_serialized_multi(self, mapping):
+        chunks, manifests = dict(), dict()
+        for key, value in mapping.items():
+            self._split(value, chunks, manifests, key)
+        if chunks:
+            self.proxied.set_serialized_multi(chunks)
+        self.proxied.set_serialized_multi(manifests)
+
+    def delete(self, key):
+        _, manifest = self._parse_manifest(self.proxied.get_serialized(key))
+        if manifest is None:
+            self.proxied.delete(key)
+        else:
+            self.proxied.delete_multi(
+                [key] + self._get_chunk_keys(manifest[0], manifest[1])
+            )
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        chunk_keys = []
+        for data in self.proxied.get_serialized_multi(keys):
+            _, manifest = self._parse_manifest(data)
+            if manifest is not None:
+                chunk_keys.extend(
+                    self._get_chunk_keys(manifest[0], manifest[1])
+                )
+        self.proxied.delete_multi(keys + chunk_keys)
+
+
+class FrequencySketch(object):
+    """
+    Compact approximate counter of key occurrences (TinyLFU): count-min
+    sketch with `depth` rows of `width` 4-bit counters. All counters are
+    halved every `10 * width` increments, so frequencies reflect recent
+    requests.
+
+    Updates take no lock, concurrent increments may be lost, which only
+    makes estimates a bit lower.
+    """
+    SEEDS = (
+        0x9E3779B97F4A7C15,
+        0xC2B2AE3D27D4EB4F,
+        0x165667B19E3779F9,
+        0x85EBCA77C2B2AE63,
+    )
+    MAX_COUNT = 15
+
+    def __init__(self, width=4096, depth=4):
+        if width < 2 or width & (width - 1):
+            raise ValueError('`width` must be a power of 2')
+        if not 0 < depth <= len(self.SEEDS):
+            raise ValueError(
+                '`depth` must be between 1 and %d' % len(self.SEEDS)
+            )
+
+        self._shift = 64 - (width.bit_length() - 1)
+        self._seeds = self.SEEDS[:depth]
+        self._rows = [bytearray(width) for _ in range(depth)]
+        self.sample_size = 10 * width
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [
+            ((h * seed) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+            for seed in self._seeds
+        ]
+
+    def increment(self, key):
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._additions = 0
+            for row in self._rows:
+                row[:] = bytes(count >> 1 for count in row)
+
+    def estimate(self, key):
+        return min(
+            row[index] for row, index in zip(self._rows, self._indexes(key))
+        )
+
+
+class AdmissionPolicy(object):
+    """
+    Decides if a created value is worth storing in cache.
+
+    :param max_size: Max serialized size of values in bytes.
+
+    :param min_creation_time: Values created faster (in seconds) are
+                              cheap to create again and aren't stored.
+
+    :param min_frequency: Values of keys requested less times recently
+                          (see `FrequencySketch`) aren't stored.
+
+    Called with value size (None if `max_size` isn't set), creation time and
+    frequency, returns None if the value is admitted or the reason it isn't:
+    'too_large', 'cheap' or 'rare'.
+    """
+    REASONS = ('too_large', 'cheap', 'rare')
+
+    def __init__(self, max_size=None, min_creation_time=None,
+                 min_frequency=None):
+        self.max_size = max_size
+        self.min_creation_time = min_creation_time
+        self.min_frequency = min_frequency
+
+    def __call__(self, size, creation_seconds, frequency):
+        if self.max_size is not None and size > self.max_size:
+            return 'too_large'
+        if (
+            self.min_creation_time is not None
+            and creation_seconds < self.min_creation_time
+        ):
+            return 'cheap'
+        if self.min_frequency is not None and frequency < self.min_frequency:
+            return 'rare'
+        return None
+
+
+class _ShardOwner(object):
+    __slots__ = ('shard', '__weakref__')
+
+
+class RegionStats(object):
+    """
+    Counters and latency histograms of one cache region.
+
+    Every thread updates its own shard, so updates need no lock. Shards are
+    summed up by `snapshot`. When a thread exits, its shard is folded into
+    a base total and dropped, so threads created per request don't pile up
+    shards.
+    """
+    COUNTERS = (
+        'hits',
+        'misses',
+        'regenerations',
+        'creation_seconds',
+        'bytes_read',
+        'bytes_written',
+        'stale_hits',
+        'stale_errors',
+        'breaker_trips',
+        'breaker_bypasses',
+        'admissions',
+        'rejections_too_large',
+        'rejections_cheap',
+        'rejections_rare',
+    )
+    HISTOGRAMS = ('backend_get_seconds', 'backend_set_seconds')
+    BUCKETS = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    )
+
+    def __init__(self):
+        self._local = local()
+        self._shards = dict()
+        self._base = self._make_shard()
+        self._lock = Lock()
+
+    def after_fork(self):
+        """
+        Drops counters inherited from the parent process.
+        """
+        self._local = local()
+        self._shards = dict()
+        self._base = self._make_shard()
+        self._lock = Lock()
+
+    def _make_shard(self):
+        shard = dict((name, 0) for name in self.COUNTERS)
+        for name in self.HISTOGRAMS:
+            shard[name] = [0] * (len(self.BUCKETS) + 1)
+            shard[name + '_sum'] = 0
+        return shard
+
+    @staticmethod
+    def _release_shard(stats_ref, shards, shard):
+        # Called when the thread owning `shard` is gone. Doesn't reference
+        # the stats object strongly, so it can be garbage collected first.
+        stats = stats_ref()
+        if stats is None or stats._shards is not shards:
+            return
+        with stats._lock:
+            shards.pop(id(shard), None)
+            base = stats._base
+            for name in stats.COUNTERS:
+                base[name] += shard[name]
+            for name in stats.HISTOGRAMS:
+                for i, count in enumerate(shard[name]):
+                    base[name][i] += count
+                base[name + '_sum'] += shard[name + '_sum']
+
+    def _get_shard(self):
+        try:
+            return self._local.owner.shard
+        except AttributeError:
+            shard = self._make_shard()
+            # Thread locals of a thread are released when it exits.
+            owner = _ShardOwner()
+            owner.shard = shard
+            finalize(
+                owner, self._release_shard, ref(self), self._shards, shard,
+            ).atexit = False
+            with self._lock:
+                self._shards[id(shard)] = shard
+            self._local.owner = owner
+            return shard
+
+    def incr(self, name, value=1):
+        self._get_shard()[name] += value
+
+    def observe(self, name, seconds):
+        shard = self._get_shard()
+        shard[name][bisect_left(self.BUCKETS, seconds)] += 1
+        shard[name + '_sum'] += seconds
+
+    def snapshot(self):
+        """
+        :return dict: counters and histograms. Each histogram is a dict with
+                      `buckets` (not cumulative counts per BUCKETS upper
+                      bound and +Inf), `sum` and `count`.
+        """
+        with self._lock:
+            shards = list(self._shards.values())
+            base = self._base
+            shards.append(dict(
+                (name, list(value) if isinstance(value, list) else value)
+                for name, value in base.items()
+            ))
+
+        result = dict(
+            (name, sum(shard[name] for shard in shards))
+            for name in self.COUNTERS
+        )
+        for name in self.HISTOGRAMS:
+            buckets = [0] * (len(self.BUCKETS) + 1)
+            for shard in shards:
+                for i, count in enumerate(shard[name]):
+                    buckets[i] += count
+            result[name] = dict(
+                buckets=buckets,
+                sum=sum(shard[name + '_sum'] for shard in shards),
+                count=sum(buckets),
+            )
+        return result
+
+
+class FunctionProfile(object):
+    """
+    Samples of calls of one function decorated with @cache.region(), see
+    DOGPILE_CACHE_PROFILE.
+
+    Only sampled calls take the lock. At most `max_samples` creation times
+    are kept (reservoir sampling) for percentiles.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.started_at = time()
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired_misses = 0
+        self.hit_seconds = 0
+        self.miss_seconds = 0
+        self.creation_seconds = 0
+        self.value_bytes = 0
+        self.sized_values = 0
+        self._creation_samples = []
+        self._lock = Lock()
+
+    def record(self, call_seconds, had_value, creation):
+        """
+        :param call_seconds: Duration of the call of cached func.
+
+        :param had_value: True if an expired value was in cache before the
+                          call.
+
+        :param creation: None for hits, else (seconds, size) of creation,
+                         size is None if it can't be measured.
+        """
+        with self._lock:
+            self.calls += 1
+            if creation is None:
+                self.hits += 1
+                self.hit_seconds += call_seconds
+                return
+
+            creation_seconds, size = creation
+            self.misses += 1
+            if had_value:
+                self.expired_misses += 1
+            self.miss_seconds += call_seconds
+            self.creation_seconds += creation_seconds
+            if size is not None:
+                self.value_bytes += size
+                self.sized_values += 1
+
+            if len(self._creation_samples) < self.max_samples:
+                self._creation_samples.append(creation_seconds)
+            else:
+                index = random.randrange(self.misses)
+                if index < self.max_samples:
+                    self._creation_samples[index] = creation_seconds
+
+    def snapshot(self):
+        """
+        :return dict: sampled counters, sums and `creation_percentiles`
+                      (p50, p90, p99 and max creation seconds).
+        """
+        with self._lock:
+            result = dict(
+                (name, getattr(self, name)) for name in (
+                    'started_at', 'calls', 'hits', 'misses',
+                    'expired_misses', 'hit_seconds', 'miss_seconds',
+                    'creation_seconds', 'value_bytes', 'sized_values',
+                )
+            )
+            samples = sorted(self._creation_samples)
+
+        result['creation_percentiles'] = dict(
+            (name, samples[min(int(len(samples) * fraction),
+                               len(samples) - 1)] if samples else None)
+            for name, fraction in (
+                ('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1),
+            )
+        )
+        return result
+
+
+class CircuitBreakerProxy(ProxyBackend):
+    """
+    Stops using a degraded backend.
+
+    Failed operations, and operations taking longer than
+    `slow_operation_threshold` seconds, are counted as failures. Errors are
+    logged and not raised: gets return NO_VALUE, so cached funcs are called
+    directly. After `failure_threshold` consecutive failures the breaker
+    opens and all operations are bypassed for `recovery_timeout` seconds.
+    Then it is half open: one operation probes the backend and closes the
+    breaker if it succeeds, others are still bypassed.
+
+    Slow operations are measured after they return, not interrupted: use
+    socket timeouts of the backend client to bound them (see
+    region_arguments).
+
+    :param stats: Optional `RegionStats` counting `breaker_trips` and
+                  `breaker_bypasses`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30,
+                 slow_operation_threshold=None, stats=None):
+        super(CircuitBreakerProxy, self).__init__()
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.slow_operation_threshold = slow_operation_threshold
+        self.stats = stats
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = Lock()
+
+    def after_fork(self):
+        """
+        Closes the breaker, the child process has its own backend clients.
+        """
+        self._lock = Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probing = False
+
+    def _allow(self):
+        if self.state == self.CLOSED:
+            return True
+
+        with self._lock:
+            if (
+                self.state == self.OPEN
+                and time() - self._opened_at >= self.recovery_timeout
+            ):
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def _succeeded(self):
+        if self.state == self.CLOSED and not self._failures:
+            return
+
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def _failed(self):
+        with self._lock:
+            self._failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN and self.stats is not None:
+                    self.stats.incr('breaker_trips')
+                self.state = self.OPEN
+                self._opened_at = time()
+                self._probing = False
+
+    def _call(self, default, method, *args):
+        if not self._allow():
+            if self.stats is not None:
+                self.stats.incr('breaker_bypasses')
+            return default
+
+        start = perf_counter()
+        try:
+            result = method(*args)
+        except Exception:
+            log.warning('Cache backend operation `%s` failed',
+                        method.__name__, exc_info=True)
+            self._failed()
+            return default
+
+        if (
+            self.slow_operation_threshold is not None
+            and perf_counter() - start > self.slow_operation_threshold
+        ):
+            self._failed()
+        else:
+            self._succeeded()
+        return result
+
+    def get(self, key):
+        return self._call(NO_VALUE, self.proxied.get, key)
+
+    def get_serialized(self, key):
+        return self._call(NO_VALUE, self.proxied.get_serialized, key)
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        return self._call([NO_VALUE] * len(keys), self.proxied.get_multi, keys)
+
+    def get_serialized_multi(self, keys):
+        keys = list(keys)
+        return self._call(
+            [NO_VALUE] * len(keys), self.proxied.get_serialized_multi, keys
+        )
+
+    def set(self, key, value):
+        self._call(None, self.proxied.set, key, value)
+
+    def set_serialized(self, key, value):
+        self._call(None, self.proxied.set_serialized, key, value)
+
+    def set_multi(self, mapping):
+        self._call(None, self.proxied.set_multi, mapping)
+
+    def set_serialized_multi(self, mapping):
+        self._call(None, self.proxied.set_serialized_multi, mapping)
+
+    def delete(self, key):
+        self._call(None, self.proxied.delete, key)
+
+    def delete_multi(self, keys):
+        self._call(None, self.proxied.delete_multi, list(keys))
+
+    def get_mutex(self, key):
+        # None makes dogpile use a process-local lock.
+        if self.state != self.CLOSED:
+            return None
+        return self.proxied.get_mutex(key)
+
+
+class StatsProxy(ProxyBackend):
+    """
+    Measures latency of backend gets and sets and size of bytes values
+    read and written into `RegionStats`.
+    """
+
+    def __init__(self, stats):
+        super(StatsProxy, self).__init__()
+        self.stats = stats
+
+    def _get(self, backend_get, key):
+        start = perf_counter()
+        value = backend_get(key)
+        self.stats.observe('backend_get_seconds', perf_counter() - start)
+        if isinstance(value, bytes):
+            self.stats.incr('bytes_read', len(value))
+        return value
+
+    def _get_multi(self, backend_get_multi, keys):
+        start = perf_counter()
+        values = backend_get_multi(keys)
+        self.stats.observe('backend_get_seconds', perf_counter() - start)
+        size = sum(len(value) for value in values if isinstance(value, bytes))
+        if size:
+            self.stats.incr('bytes_read', size)
+        return values
+
+    def _set(self, backend_set, key, value):
+        start = perf_counter()
+        backend_set(key, value)
+        self.stats.observe('backend_set_seconds', perf_counter() - start)
+        if isinstance(value, bytes):
+            self.stats.incr('bytes_written', len(value))
+
+    def _set_multi(self, backend_set_multi, mapping):
+        start = perf_counter()
+        backend_set_multi(mapping)
+        self.stats.observe('backend_set_seconds', perf_counter() - start)
+        size = sum(
+            len(value) for value in mapping.values()
+            if isinstance(value, bytes)
+        )
+        if size:
+            self.stats.incr('bytes_written', size)
+
+    def get(self, key):
+        return self._get(self.proxied.get, key)
+
+    def get_serialized(self, key):
+        return self._get(self.proxied.get_serialized, key)
+
+    def get_multi(self, keys):
+        return self._get_multi(self.proxied.get_multi, keys)
+
+    def get_serialized_multi(self, keys):
+        return self._get_multi(self.proxied.get_serialized_multi, keys)
+
+    def set(self, key, value):
+        self._set(self.proxied.set, key, value)
+
+    def set_serialized(self, key, value):
+        self._set(self.proxied.set_serialized, key, value)
+
+    def set_multi(self, mapping):
+        self._set_multi(self.proxied.set_multi, mapping)
+
+    def set_serialized_multi(self, mapping):
+        self._set_multi(self.proxied.set_serialized_multi, mapping)
+
+
+class L1CacheProxy(ProxyBackend):
+    """
+    Process-local LRU tier in front of a region backend.
+
+    Values are kept for at most `timeout` seconds and at most `size` values
+    are kept at once. Writes and deletes go through to the proxied backend.
+
+    Values which `region` would regenerate (expired or invalidated with
+    `region.invalidate()`) aren't kept. Without `serializer` region option
+    the same value object is returned to every caller, so values must not
+    be mutated.
+
+    `region` must be set to configured region before use.
+    """
+
+    def __init__(self, size, timeout):
+        super(L1CacheProxy, self).__init__()
+        self.size = size
+        self.timeout = timeout
+        self.region = None
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_created_at(value):
+        """
+        Returns creation time of dogpile's CachedValue or its serialized
+        form, None if it isn't known.
+        """
+        try:
+            if isinstance(value, bytes):
+                return json.loads(value.partition(b'|')[0])['ct']
+            return value.metadata['ct']
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def _is_valid(self, created_at):
+        if created_at is None:
+            return False
+        if (
+            self.region.expiration_time is not None
+            and time() - created_at > self.region.expiration_time
+        ):
+            return False
+        return not self.region.region_invalidator.is_invalidated(created_at)
+
+    def _get_local(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is not None:
+                expires_at, created_at, value = item
+                if expires_at > time() and self._is_valid(created_at):
+                    self._values.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._values[key]
+            self.misses += 1
+            return NO_VALUE
+
+    def _set_local(self, key, value):
+        created_at = self._get_created_at(value)
+        if not self._is_valid(created_at):
+            self._delete_local([key])
+            return
+
+        expires_at = time() + self.timeout
+        with self._lock:
+            self._values[key] = (expires_at, created_at, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+    def _delete_local(self, keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def _get(self, key, backend_get):
+        value = self._get_local(key)
+        if value is NO_VALUE:
+            value = backend_get(key)
+            if value is not NO_VALUE and value is not None:
+                self._set_local(key, value)
+        return value
+
+    def _get_multi(self, keys, backend_get_multi):
+        values = [self._get_local(key) for key in keys]
+        missed = [i for i, value in enumerate(values) if value is NO_VALUE]
+        if missed:
+            fetched = backend_get_multi([keys[i] for i in missed])
+            for i, value in zip(missed, fetched):
+                values[i] = value
+                if value is not NO_VALUE and value is not None:
+                    self._set_local(keys[i], value)
+        return values
+
+    def _set_multi(self, mapping, backend_set_multi):
+        backend_set_multi(mapping)
+        for key, value in mapping.items():
+            self._set_local(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def after_fork(self):
+        """
+        Replaces the lock, which could be held by a thread of the parent
+        process. Values are kept, they are still valid in the child.
+        """
+        self._lock = Lock()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._values))
+
+    def get(self, key):
+        return self._get(key, self.proxied.get)
+
+    def get_serialized(self, key):
+        return self._get(key, self.proxied.get_serialized)
+
+    def get_multi(self, keys):
+        return self._get_multi(list(keys), self.proxied.get_multi)
+
+    def get_serialized_multi(self, keys):
+        return self._get_multi(list(keys), self.proxied.get_serialized_multi)
+
+    def set(self, key, value):
+        self.proxied.set(key, value)
+        self._set_local(key, value)
+
+    def set_serialized(self, key, value):
+        self.proxied.set_serialized(key, value)
+        self._set_local(key, value)
+
+    def set_multi(self, mapping):
+        self._set_multi(mapping, self.proxied.set_multi)
+
+    def set_serialized_multi(self, mapping):
+        self._set_multi(mapping, self.proxied.set_serialized_multi)
+
+    def delete(self, key):
+        self._delete_local([key])
+        self.proxied.delete(key)
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        self._delete_local(keys)
+        self.proxied.delete_multi(keys)
+
+
+class ShardedBackend(CacheBackend):
+    """
+    Spreads keys over backends of `url` list with consistent hashing, so
+    adding or removing a url moves about 1/len(url) of keys.
+
+    Hot keys are written to `replicas` consecutive backends on the hash
+    ring and read from a random one of them. Keys are hot if they are
+    marked with `mark_hot()` (see `hot` param of @cache.region()) or if
+    at least `hot_key_threshold` of their reads are sampled in
+    `hot_key_window` seconds (every read is sampled with
+    `hot_key_sample_rate` probability). At most `max_hot_keys` keys are hot
+    at once, least recently marked ones stop being hot first. Replicas of
+    keys which stopped being hot are deleted on their next write in this
+    process (for up to `max_hot_keys` such keys), never on reads.
+
+    Hot keys are detected by each process independently. Deletes always go
+    to all replicas. Writes of keys which aren't hot in this process go to
+    the primary backend only, so replicas written by processes where the
+    key is hot may hold the previous value until it's rewritten or
+    expires. With `hot_key_cleanup` such writes also delete the replicas
+    (one more call per replica on every write), so a replica holds either
+    a fresh value or nothing.
+
+    Arguments:
+
+        backend (str, required) - dogpile backend of every url.
+        url (list, required) - urls, one backend per url.
+        arguments (dict) - other arguments of every backend.
+        virtual_nodes (int) - points of each url on the ring, 160 by
+            default.
+        replicas (int) - backends holding each hot key, 2 by default.
+        hot_key_sample_rate (float) - 0.01 by default, 0 disables
+            detection of hot keys.
+        hot_key_threshold (int) - 20 by default.
+        hot_key_window (float) - 10 by default.
+        max_hot_keys (int) - 1000 by default.
+        hot_key_cleanup (bool) - False by default.
+    """
+
+    def __init__(self, arguments):
+        urls = arguments['url']
+        if isinstance(urls, str):
+            urls = [urls]
+        if not urls:
+            raise ValueError('`url` must not be empty')
+
+        backend_arguments = arguments.get('arguments', {})
+        self.backends = [
+            make_region().configure(
+                arguments['backend'],
+                arguments=dict(backend_arguments, url=url),
+            ).backend
+            for url in urls
+        ]
+        self.serializer = self.backends[0].serializer
+        self.deserializer = self.backends[0].deserializer
+        self.key_mangler = self.backends[0].key_mangler
+
+        self.replicas = min(arguments.get('replicas', 2), len(urls))
+        self.hot_key_sample_rate = arguments.get('hot_key_sample_rate', 0.01)
+        self.hot_key_threshold = arguments.get('hot_key_threshold', 20)
+        self.hot_key_window = arguments.get('hot_key_window', 10)
+        self.max_hot_keys = arguments.get('max_hot_keys', 1000)
+        self.hot_key_cleanup = arguments.get('hot_key_cleanup', False)
+        self._hot_keys = OrderedDict()
+        self._evicted_hot_keys = OrderedDict()
+        self._sampled_reads = dict()
+        self._window_started_at = time()
+        self._lock = Lock()
+
+        ring = sorted(
+            (self._hash('%s#%d' % (url, i)), index)
+            for index, url in enumerate(urls)
+            for i in range(arguments.get('virtual_nodes', 160))
+        )
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_indexes = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def get_indexes(self, key, count=1):
+        """
+        :return list: indexes of `count` backends following `key` on the
+                      ring, the first one is the primary backend of `key`.
+        """
+        position = bisect_left(self._ring_hashes, self._hash(key))
+        indexes = []
+        for i in range(len(self._ring_indexes)):
+            index = self._ring_indexes[
+                (position + i) % len(self._ring_indexes)
+            ]
+            if index not in indexes:
+                indexes.append(index)
+                if len(indexes) == count:
+                    break
+        return indexes
+
+    def is_hot(self, key):
+        return key in self._hot_keys
+
+    def hot_keys(self):
+        return list(self._hot_keys)
+
+    def mark_hot(self, key):
+        with self._lock:
+            if key in self._hot_keys:
+                self._hot_keys.move_to_end(key)
+                return
+
+            self._hot_keys[key] = True
+            # Unless it was written since, replicas hold the last value.
+            self._evicted_hot_keys.pop(key, None)
+            while len(self._hot_keys) > self.max_hot_keys:
+                evicted_key = self._hot_keys.popitem(last=False)[0]
+                self._evicted_hot_keys[evicted_key] = True
+            while len(self._evicted_hot_keys) > self.max_hot_keys:
+                self._evicted_hot_keys.popitem(last=False)
+
+    def _needs_cleanup(self, key):
+        """
+        :return bool: True if replicas of `key` which isn't hot have to be
+                      deleted when it's written.
+        """
+        if self.hot_key_cleanup:
+            return True
+        if key not in self._evicted_hot_keys:
+            return False
+        with self._lock:
+            return self._evicted_hot_keys.pop(key, None) is not None
+
+    def _sample(self, key):
+        if random.random() >= self.hot_key_sample_rate:
+            return
+
+        with self._lock:
+            now = time()
+            if now - self._window_started_at > self.hot_key_window:
+                self._sampled_reads.clear()
+                self._window_started_at = now
+            reads = self._sampled_reads[key] = (
+                self._sampled_reads.get(key, 0) + 1
+            )
+        if reads >= self.hot_key_threshold:
+            self.mark_hot(key)
+
+    def _read(self, get_name, set_name, key):
+        if self.hot_key_sample_rate:
+            self._sample(key)
+        if key not in self._hot_keys:
+            return getattr(
+                self.backends[self.get_indexes(key)[0]], get_name
+            )(key)
+
+        indexes = self.get_indexes(key, self.replicas)
+        index = random.choice(indexes)
+        value = getattr(self.backends[index], get_name)(key)
+        if value is NO_VALUE and index != indexes[0]:
+            value = getattr(self.backends[indexes[0]], get_name)(key)
+            if value is not NO_VALUE:
+                getattr(self.backends[index], set_name)(key, value)
+        return value
+
+    def _read_multi(self, get_name, get_multi_name, set_name, keys):
+        values = [NO_VALUE] * len(keys)
+        positions_by_index = dict()
+        for position, key in enumerate(keys):
+            if key in self._hot_keys:
+                values[position] = self._read(get_name, set_name, key)
+                continue
+            if self.hot_key_sample_rate:
+                self._sample(key)
+            positions_by_index.setdefault(
+                self.get_indexes(key)[0], []
+            ).append(position)
+
+        for index, positions in positions_by_index.items():
+            fetched = getattr(self.backends[index], get_multi_name)(
+                [keys[position] for position in positions]
+            )
+            for position, value in zip(positions, fetched):
+                values[position] = value
+        return values
+
+    def _write(self, set_name, key, value):
+        is_hot = key in self._hot_keys
+        if not is_hot and not self._needs_cleanup(key):
+            getattr(
+                self.backends[self.get_indexes(key)[0]], set_name
+            )(key, value)
+            return
+
+        indexes = self.get_indexes(key, self.replicas)
+        if is_hot:
+            for index in indexes:
+                getattr(self.backends[index], set_name)(key, value)
+        else:
+            getattr(self.backends[indexes[0]], set_name)(key, value)
+            for index in indexes[1:]:
+                self.backends[index].delete(key)
+
+    def _write_multi(self, set_multi_name, mapping):
+        mappings_by_index = dict()
+        deleted_by_index = dict()
+        for key, value in mapping.items():
+            indexes = self.get_indexes(key, self.replicas)
+            if key in self._hot_keys:
+                written, deleted = indexes, []
+            elif self._needs_cleanup(key):
+                written, deleted = indexes[:1], indexes[1:]
+            else:
+                written, deleted = indexes[:1], []
+            for index in written:
+                mappings_by_index.setdefault(index, {})[key] = value
+            for index in deleted:
+                deleted_by_index.setdefault(index, []).append(key)
+
+        for index, index_mapping in mappings_by_index.items():
+            getattr(self.backends[index], set_multi_name)(index_mapping)
+        for index, keys in deleted_by_index.items():
+            self.backends[index].delete_multi(keys)
+
+    def get(self, key):
+        return self._read('get', 'set', key)
+
+    def get_serialized(self, key):
+        return self._read('get_serialized', 'set_serialized', key)
+
+    def get_multi(self, keys):
+        return self._read_multi('get', 'get_multi', 'set', list(keys))
+
+    def get_serialized_multi(self, keys):
+        return self._read_multi('get_serialized', 'get_serialized_multi',
+                                'set_serialized', list(keys))
+
+    def set(self, key, value):
+        self._write('set', key, value)
+
+    def set_serialized(self, key, value):
+        self._write('set_serialized', key, value)
+
+    def set_multi(self, mapping):
+        self._write_multi('set_multi', mapping)
+
+    def set_serialized_multi(self, mapping):
+        self._write_multi('set_serialized_multi', mapping)
+
+    def delete(self, key):
+        for index in self.get_indexes(key, self.replicas):
+            self.backends[index].delete(key)
+
+    def delete_multi(self, keys):
+        keys_by_index = dict()
+        for key in keys:
+            for index in self.get_indexes(key, self.replicas):
+                keys_by_index.setdefault(index, []).append(key)
+        for index, index_keys in keys_by_index.items():
+            self.backends[index].delete_multi(index_keys)
+
+    def get_mutex(self, key):
+        return self.backends[self.get_indexes(key)[0]].get_mutex(key)
+
+
+register_backend('flask_dogpile_cache.sharded', __name__, 'ShardedBackend')
+
+
+class DogpileCache(object):
+    FUNC_REGION_NAME_ATTR = 'dogpile_cache_region_name'
+    FUNC_ORIGINAL_ATTR = 'dogpile_cache_original_func'
+    FUNC_TAGS_ATTR = 'dogpile_cache_tags'
+    FUNC_HOT_ATTR = 'dogpile_cache_hot'
+    FUNC_ADMISSION_ATTR = 'dogpile_cache_admission'
+    FUNC_VIEW_ATTR = 'dogpile_cache_view'
+    TAG_KEY = 'flask_dogpile_cache:tag|%s'
+    # expiration_time of get_multi() which still checks region invalidation.
+    NO_EXPIRATION = float('inf')
+
+    def __init__(self, app=None, config=None, wrappers_debug=None,
+                 wrappers_production=None):
+        """
+        :param app: Flask app object.
+
+        :param config: Configuration dict.
+
+            DOGPILE_CACHE_BACKEND
+                Optional. 'dogpile.cache.memcached' by default.
+                You can override it with other available backends from
+                dogpile.cache.
+
+            DOGPILE_CACHE_URLS
+                Required if not declared for each region.
+                A list or tuple of cache servers' urls.
+                For example, ["127.0.0.1:11211"].
+
+            DOGPILE_CACHE_REGIONS
+                Required. A list or tuple of region_data_tuples. Each
+                region_data_tuple has from 2 to 6 elements:
+                1) region_name (str, required). For example, 'hour'.
+                2) region_timeout (int, required). For example, 3600.
+                3) region_backend (str, optional). If not declared takes
+                   its value from DOGPILE_CACHE_BACKEND.
+                4) region_urls (list or tuple, optional). If not declared
+                   takes its value from DOGPILE_CACHE_URLS.
+                5) region_arguments (dict, optional). See description bellow.
+                6) region_options (dict, optional). If not declared takes
+                   its value from DOGPILE_CACHE_REGION_OPTIONS.
+
+            DOGPILE_CACHE_ARGUMENTS
+                Optional.  The structure here is passed directly to the
+                constructor of the class `CacheBackend` in use, though is
+                typically a dictionary.
+
+            DOGPILE_CACHE_KEY_MANGLER
+                Optional. A dict of `KeyMangler` arguments or a callable
+                which accepts key str and returns mangled key str. By default
+                args part of keys is replaced with its md5 hex digest.
+                For example, {'algorithm': 'blake2b', 'digest_size': 16,
+                'max_plain_length': 64}.
+
+            DOGPILE_CACHE_REQUEST_MEMO
+                Optional. False by default. If True, values of funcs
+                decorated with @cache.region() are memoized for the duration
+                of a request, so repeated calls with the same arguments go
+                to cache server only once.
+
+            DOGPILE_CACHE_ASYNC_WORKERS
+                Optional. 4 by default. Number of threads running cache
+                server calls for coroutine functions decorated with
+                @cache.region() and for `cache.*_async()` methods.
+
+            DOGPILE_CACHE_STATS
+                Optional. True by default. Collects hits, misses,
+                regenerations and backend latency of every region, see
+                `cache.stats()`.
+
+            DOGPILE_CACHE_PROFILE
+                Optional. 0 (disabled) by default. Fraction of calls of
+                funcs decorated with @cache.region() which are profiled,
+                for example 0.01. Each sampled call makes one more
+                cache server get. See `cache.profile()`.
+
+            DOGPILE_CACHE_REGION_OPTIONS
+                Optional. A dict of extension options for regions:
+                l1_size (int) - enables process-local LRU tier in front of
+                    the region backend holding at most l1_size values.
+                    Without `serializer` the same value object is returned
+                    by every call, see `L1CacheProxy`.
+                l1_timeout (int) - seconds to keep values in the local tier,
+                    5 by default. Never exceeds region_timeout.
+                function_key_generator (callable) - see dogpile's
+                    `CacheRegion.function_key_generator`.
+                    `signature_key_generator` by default.
+                typed_keys (bool) - if True, arguments are converted to
+                    keys with `typed_to_str`, so `f(1)` and `f('1')` are
+                    cached separately.
+                refresh_ahead (float) - enables refresh-ahead: values hit
+                    within this fraction of region_timeout before expiration
+                    (for example, 0.1) are served and regenerated in
+                    background.
+                stale_while_revalidate (int) - seconds after expiration
+                    during which values are served while regenerated in
+                    background. Older values are regenerated synchronously.
+                    Served values are counted in `stale_hits` stats.
+                stale_if_error (int) - seconds after expiration during
+                    which values are served if func raises an exception.
+                    Such calls are logged and counted in `stale_errors`
+                    stats; the exception is raised for older values. Not
+                    applied to funcs with tags and coroutine functions.
+                refresh_ahead_workers (int) - threads regenerating values of
+                    the region (also for stale_while_revalidate), 2 by
+                    default.
+                refresh_ahead_max_pending (int) - max queued regenerations,
+                    100 by default. Further hits are served without
+                    scheduling regeneration.
+                serializer (str) - 'pickle', 'json' or 'msgpack' (see
+                    `make_serializer`). By default values are serialized
+                    by backend. Values which can't be deserialized, e.g.
+                    stored with other serializer, are cache misses.
+                pickle_protocol (int) - highest by default.
+                compression (str) - 'zlib' or 'lzma'. Serialized values are
+                    compressed with `CompressionProxy`. Implies 'pickle'
+                    serializer if it isn't declared.
+                compression_threshold (int) - min size in bytes of values to
+                    compress, 1024 by default.
+                compression_level (int) - 6 by default.
+                chunking (bool) - if True, serialized values longer than
+                    chunk_size are stored in several keys, see
+                    `ChunkingProxy`. Implies 'pickle' serializer if it
+                    isn't declared.
+                chunk_size (int) - max bytes stored in one key, 1000000 by
+                    default.
+                admission (dict) - params of `AdmissionPolicy` applied to
+                    values created by funcs of the region (except funcs
+                    with tags and coroutine functions), for example
+                    {'max_size': 100000, 'min_frequency': 2}. Decisions
+                    are counted in `admissions` and `rejections_*` stats.
+                admission_sketch_width (int) - counters in each row of
+                    region's `FrequencySketch`, 4096 by default.
+                single_flight (bool) - if True, concurrent calls of the same
+                    func with the same arguments in one process share one
+                    cache server read and one func call. To also share
+                    func calls between processes, pass
+                    `distributed_lock=True` in region_arguments (supported
+                    by dogpile's memcached backends).
+                shared_invalidation (bool) - if True, `invalidate_region`
+                    is seen by all processes, see
+                    `SharedInvalidationStrategy`.
+                invalidation_check_interval (float) - max seconds for
+                    other processes to see shared invalidation, 1 by
+                    default.
+                circuit_breaker (bool) - if True, backend errors aren't
+                    raised and the backend is bypassed after repeated
+                    failures, see `CircuitBreakerProxy`.
+                circuit_breaker_threshold (int) - consecutive failures to
+                    open the breaker, 5 by default.
+                circuit_breaker_recovery (float) - seconds before probing
+                    the backend again, 30 by default.
+                slow_operation_threshold (float) - backend operations
+                    which took longer (in seconds) are counted as failures
+                    by the breaker. They aren't interrupted, see
+                    `CircuitBreakerProxy`.
+                sharding (bool) - if True, keys are spread over region_urls
+                    (one backend per url) by the extension with consistent
+                    hashing and hot keys are replicated, see
+                    `ShardedBackend`.
+                virtual_nodes (int) - points of each url on the hash ring,
+                    160 by default.
+                hot_key_replicas (int) - backends holding each hot key, 2
+                    by default.
+                hot_key_sample_rate, hot_key_threshold, hot_key_window,
+                max_hot_keys - detection of hot keys, see `ShardedBackend`.
+                hot_key_cleanup (bool) - if True, writes of keys which
+                    aren't hot in this process delete their replicas too,
+                    see `ShardedBackend`.
+
+            The simplest config is:
+                DOGPILE_CACHE_URLS = ["127.0.0.1:11211"]
+                DOGPILE_CACHE_REGIONS = [
+                    ('hour', 3600),
+                    ('day', 3600 * 24),
+                ]
+
+        :param wrappers_debug, wrappers_production:
+            A decorator class for altering the functionality of backends.
+            Example:
+
+                from dogpile.cache.proxy import ProxyBackend
+
+                class DebugProxy(ProxyBackend):
+                    @timer  # custom decorator that logs calls duration
+                    def get(self, key):
+                        return self.proxied.get(key)
+
+                    @timer
+                    def set(self, key, value):
+                        return self.proxied.set(key, value)
+
+                    @timer
+                    def delete(self, key):
+                        return self.proxied.delete(key)
+
+        """
+        self.config = config
+        self.app = app
+        self._wrappers_debug = wrappers_debug
+        self._wrappers_production = wrappers_production
+        self._cache_regions = NotInitialized()
+        self._cache_regions_decorators = NotInitialized()
+        self._region_specs = OrderedDict()
+        self._regions_lock = Lock()
+        self._cached_funcs = dict()
+        self._key_generators = dict()
+        self._l1_proxies = dict()
+        self._circuit_breakers = dict()
+        self._sketches = dict()
+        self._refresh_ahead_runners = dict()
+        self._region_stats = dict()
+        self._single_flight_region_names = set()
+        self._profile_rate = 0
+        self._profiles = dict()
+        self._local = local()
+        self._warmers = []
+        self._async_workers = 4
+        self._async_executor = None
+        self._async_executor_lock = Lock()
+        self._request_memo = False
+        self._shutdown_registered = False
+
+        _instances.add(self)
+
+        if app is not None:
+            self.init_app(app, config)
+
+    def init_app(self, app, config=None, wrappers_debug=None,
+                 wrappers_production=None):
+        if not isinstance(config, (type(None), dict)):
+            raise ValueError("`config` must be dict or NoneType")
+
+        if config is None:
+            config = self.config
+            if config is None:
+                config = app.config
+
+        config.setdefault('DOGPILE_CACHE_BACKEND', 'dogpile.cache.memcached')
+        config.setdefault('DOGPILE_CACHE_URLS', None)
+        config.setdefault('DOGPILE_CACHE_ARGUMENTS', {})
+        config.setdefault('DOGPILE_CACHE_REGION_OPTIONS', {})
+        config.setdefault('DOGPILE_CACHE_REQUEST_MEMO', False)
+        config.setdefault('DOGPILE_CACHE_KEY_MANGLER', None)
+        config.setdefault('DOGPILE_CACHE_STATS', True)
+        config.setdefault('DOGPILE_CACHE_ASYNC_WORKERS', 4)
+        config.setdefault('DOGPILE_CACHE_PROFILE', 0)
+        if not (
+            isinstance(config['DOGPILE_CACHE_REGIONS'], (list, tuple))
+            and config['DOGPILE_CACHE_REGIONS']
+        ):
+            raise ValueError('`DOGPILE_CACHE_REGIONS` must be list or tuple')
+        if not isinstance(config['DOGPILE_CACHE_ARGUMENTS'], dict):
+            raise ValueError('`DOGPILE_CACHE_ARGUMENTS` must be dict')
+        if not isinstance(config['DOGPILE_CACHE_REGION_OPTIONS'], dict):
+            raise ValueError('`DOGPILE_CACHE_REGION_OPTIONS` must be dict')
+        if not (
+            config['DOGPILE_CACHE_KEY_MANGLER'] is None
+            or isinstance(config['DOGPILE_CACHE_KEY_MANGLER'], dict)
+            or callable(config['DOGPILE_CACHE_KEY_MANGLER'])
+        ):
+            raise ValueError(
+                '`DOGPILE_CACHE_KEY_MANGLER` must be dict or callable'
+            )
+        if not (
+            isinstance(config['DOGPILE_CACHE_PROFILE'], (int, float))
+            and 0 <= config['DOGPILE_CACHE_PROFILE'] <= 1
+        ):
+            raise ValueError('`DOGPILE_CACHE_PROFILE` must be from 0 to 1')
+
+        self._profile_rate = config['DOGPILE_CACHE_PROFILE']
+        self._async_workers = config['DOGPILE_CACHE_ASYNC_WORKERS']
+        self._request_memo = bool(config['DOGPILE_CACHE_REQUEST_MEMO'])
+        if self._request_memo:
+            teardown_funcs = app.teardown_request_funcs.get(None, [])
+            if self._clear_request_memo not in teardown_funcs:
+                app.teardown_request(self._clear_request_memo)
+
+        wrappers_debug = wrappers_debug or self._wrappers_debug
+        wrappers_production = wrappers_production or self._wrappers_production
+
+        self._set_cache_regions(
+            app=app,
+            config=config,
+            wrappers_debug=wrappers_debug,
+            wrappers_production=wrappers_production,
+        )
+
+    def _set_cache_regions(self, app, config, wrappers_debug,
+                           wrappers_production):
+        """
+        Validates regions config. Regions themselves are configured lazily,
+        when they are used for the first time (see `get_region`).
+        """
+        self._cache_regions = dict()
+        self._cache_regions_decorators = dict()
+        self._region_specs = OrderedDict()
+        self._cached_funcs.clear()
+        self._key_generators.clear()
+        self._l1_proxies = dict()
+        self._circuit_breakers = dict()
+        self._sketches = dict()
+        self.shutdown(wait=False)
+        self._refresh_ahead_runners = dict()
+        self._region_stats = dict()
+        self._single_flight_region_names = set()
+        self._profiles = dict()
+
+        wrappers = wrappers_debug if app.debug else wrappers_production
+        if wrappers is None:
+            wrappers = []
+        elif not isinstance(wrappers, (list, tuple)):
+            wrappers = [wrappers]
+
+        key_mangler = config['DOGPILE_CACHE_KEY_MANGLER']
+        if key_mangler is None:
+            key_mangler = KeyMangler()
+        elif isinstance(key_mangler, dict):
+            key_mangler = KeyMangler(**key_mangler)
+
+        for region_tuple in config['DOGPILE_CACHE_REGIONS']:
+            if len(region_tuple) < 2:
+                raise ValueError(
+                    '`DOGPILE_CACHE_REGIONS` tuple item length '
+                    'must be at least 2: region_name and region_timeout'
+                )
+
+            region_name = region_tuple[0]
+            region_timeout = region_tuple[1]
+
+            if len(region_tuple) > 2:
+                region_backend = region_tuple[2]
+            elif config['DOGPILE_CACHE_BACKEND']:
+                region_backend = config['DOGPILE_CACHE_BACKEND']
+            else:
+                raise ValueError(
+                    '`DOGPILE_CACHE_BACKEND` must be specified '
+                    'or not initialized at all (for default value)'
+                )
+
+            if len(region_tuple) > 3:
+                region_urls = region_tuple[3]
+            elif config['DOGPILE_CACHE_URLS']:
+                region_urls = config['DOGPILE_CACHE_URLS']
+            else:
+                raise ValueError("`DOGPILE_CACHE_URLS` must be specified")
+
+            if len(region_tuple) > 4:
+                region_arguments = region_tuple[4]
+                if not isinstance(region_arguments, dict):
+                    raise ValueError('`regions_arguments` must be dict')
+            else:
+                region_arguments = config['DOGPILE_CACHE_ARGUMENTS']
+
+            arguments = dict(url=region_urls)
+            arguments.update(region_arguments)
+
+            if len(region_tuple) > 5:
+                region_options = region_tuple[5]
+                if not isinstance(region_options, dict):
+                    raise ValueError('`region_options` must be dict')
+            else:
+                region_options = config['DOGPILE_CACHE_REGION_OPTIONS']
+
+            if region_options.get('sharding'):
+                if not isinstance(region_urls, (list, tuple)):
+                    raise ValueError(
+                        '`sharding` requires list or tuple of urls'
+                    )
+                if region_options.get('hot_key_replicas', 2) < 1:
+                    raise ValueError('`hot_key_replicas` must be positive')
+                arguments = dict(
+                    backend=region_backend,
+                    url=region_urls,
+                    arguments=region_arguments,
+                    virtual_nodes=region_options.get('virtual_nodes', 160),
+                    replicas=region_options.get('hot_key_replicas', 2),
+                )
+                for option in ('hot_key_sample_rate', 'hot_key_threshold',
+                               'hot_key_window', 'max_hot_keys',
+                               'hot_key_cleanup'):
+                    if option in region_options:
+                        arguments[option] = region_options[option]
+                region_backend = 'flask_dogpile_cache.sharded'
+
+            region_wrappers = list(wrappers)
+            if region_options.get('l1_size'):
+                l1_proxy = L1CacheProxy(
+                    size=region_options['l1_size'],
+                    timeout=min(region_options.get('l1_timeout', 5),
+                                region_timeout),
+                )
+                region_wrappers.insert(0, l1_proxy)
+                self._l1_proxies[region_name] = l1_proxy
+
+            if region_options.get('single_flight'):
+                self._single_flight_region_names.add(region_name)
+
+            serializer = deserializer = None
+            serializer_name = region_options.get('serializer')
+            if region_options.get('compression'):
+                region_wrappers.append(CompressionProxy(
+                    algorithm=region_options['compression'],
+                    threshold=region_options.get(
+                        'compression_threshold', 1024
+                    ),
+                    level=region_options.get('compression_level', 6),
+                ))
+                serializer_name = serializer_name or 'pickle'
+            if region_options.get('chunking'):
+                region_wrappers.append(ChunkingProxy(
+                    region_options.get('chunk_size', 1000000)
+                ))
+                serializer_name = serializer_name or 'pickle'
+            if serializer_name:
+                serializer, deserializer = make_serializer(
+                    serializer_name,
+                    region_options.get(
+                        'pickle_protocol', pickle.HIGHEST_PROTOCOL
+                    ),
+                )
+
+            region_stats = None
+            if config['DOGPILE_CACHE_STATS']:
+                region_stats = self._region_stats[region_name] = RegionStats()
+
+            if region_options.get('circuit_breaker'):
+                circuit_breaker = CircuitBreakerProxy(
+                    failure_threshold=region_options.get(
+                        'circuit_breaker_threshold', 5
+                    ),
+                    recovery_timeout=region_options.get(
+                        'circuit_breaker_recovery', 30
+                    ),
+                    slow_operation_threshold=region_options.get(
+                        'slow_operation_threshold'
+                    ),
+                    stats=region_stats,
+                )
+                region_wrappers.append(circuit_breaker)
+                self._circuit_breakers[region_name] = circuit_breaker
+
+            if region_stats is not None:
+                region_wrappers.append(StatsProxy(region_stats))
+
+            function_key_generator = region_options.get(
+                'function_key_generator', signature_key_generator
+            )
+            if region_options.get('typed_keys'):
+                function_key_generator = partial(
+                    function_key_generator, to_str=typed_to_str
+                )
+
+            expiration_time = region_timeout
+            max_age = None
+            if region_options.get('refresh_ahead'):
+                refresh_ahead = region_options['refresh_ahead']
+                if not 0 < refresh_ahead < 1:
+                    raise ValueError(
+                        '`refresh_ahead` must be between 0 and 1'
+                    )
+                expiration_time = region_timeout * (1 - refresh_ahead)
+                max_age = region_timeout
+
+            stale_after = None
+            for option in ('stale_while_revalidate', 'stale_if_error'):
+                if region_options.get(option, 0) < 0:
+                    raise ValueError('`%s` must not be negative' % option)
+            if region_options.get('stale_while_revalidate'):
+                max_age = (
+                    region_timeout + region_options['stale_while_revalidate']
+                )
+                stale_after = region_timeout
+
+            admission_policy = None
+            if region_options.get('admission') is not None:
+                admission_policy = self._make_admission_policy(
+                    region_options['admission']
+                )
+                self._sketches[region_name] = FrequencySketch(
+                    region_options.get('admission_sketch_width', 4096)
+                )
+
+            self._region_specs[region_name] = dict(
+                backend=region_backend,
+                admission_policy=admission_policy,
+                timeout=region_timeout,
+                expiration_time=expiration_time,
+                max_age=max_age,
+                stale_after=stale_after,
+                arguments=arguments,
+                options=region_options,
+                wrappers=region_wrappers,
+                key_mangler=key_mangler,
+                function_key_generator=function_key_generator,
+                serializer=serializer,
+                deserializer=deserializer,
+            )
+
+        if hasattr(app, 'cli') and cli.name not in app.cli.commands:
+            app.cli.add_command(cli)
+
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+
+        app.extensions['dogpile_cache'] = self
+
+    def _make_region(self, region_name):
+        """
+        Configures region declared in config on first use.
+
+        Will raise KeyError if region isn't declared.
+        """
+        with self._regions_lock:
+            if region_name in self._cache_regions:
+                return self._cache_regions[region_name]
+
+            spec = self._region_specs[region_name]
+            options = spec['options']
+
+            should_cache_fn = None
+            if options.get('stale_if_error'):
+                should_cache_fn = self._is_not_stale
+
+            async_creation_runner = None
+            if spec['max_age'] is not None:
+                async_creation_runner = RefreshAheadRunner(
+                    workers=options.get('refresh_ahead_workers', 2),
+                    max_pending=options.get('refresh_ahead_max_pending', 100),
+                    should_cache_fn=should_cache_fn,
+                )
+                self._refresh_ahead_runners[region_name] = (
+                    async_creation_runner
+                )
+                if not self._shutdown_registered:
+                    atexit.register(self.shutdown)
+                    self._shutdown_registered = True
+
+            on_stale = None
+            region_stats = self._region_stats.get(region_name)
+            if region_stats is not None:
+                on_stale = partial(region_stats.incr, 'stale_hits')
+
+            if options.get('shared_invalidation'):
+                region_invalidator = SharedInvalidationStrategy(
+                    region_name,
+                    check_interval=options.get(
+                        'invalidation_check_interval', 1
+                    ),
+                    max_age=spec['max_age'],
+                    stale_after=spec['stale_after'],
+                    on_stale=on_stale,
+                )
+            elif spec['max_age'] is not None:
+                region_invalidator = MaxAgeInvalidationStrategy(
+                    spec['max_age'], spec['stale_after'], on_stale
+                )
+            else:
+                region_invalidator = None
+
+            region = make_region(
+                function_key_generator=spec['function_key_generator'],
+                key_mangler=spec['key_mangler'],
+                async_creation_runner=async_creation_runner,
+                serializer=spec['serializer'],
+                deserializer=spec['deserializer'],
+            ).configure(
+                backend=spec['backend'],
+                expiration_time=spec['expiration_time'],
+                arguments=spec['arguments'],
+                wrap=spec['wrappers'],
+                region_invalidator=region_invalidator,
+            )
+            if isinstance(region_invalidator, SharedInvalidationStrategy):
+                region_invalidator.region = region
+            if region_name in self._l1_proxies:
+                self._l1_proxies[region_name].region = region
+
+            self._cache_regions_decorators[region_name] = (
+                region.cache_on_arguments(should_cache_fn=should_cache_fn)
+            )
+            self._cache_regions[region_name] = region
+            return region
+
+    def _has_region(self, region_name):
+        """
+        Checks if region is declared in config, without configuring it.
+
+        Will raise RunTimeError if call it before `init_app` method.
+        """
+        if isinstance(self._cache_regions, NotInitialized):
+            raise RuntimeError('working outside of application context')
+
+        return region_name in self._region_specs
+
+    def get_region(self, region_name):
+        """
+        Method for getting already configured cache region.
+
+        :param region_name: Name for region from config (for example, 'hour').
+
+        :return <CacheRegion object>:
+
+        Will raise RunTimeError if call it before `init_app` method.
+        """
+        if isinstance(self._cache_regions, NotInitialized):
+            raise RuntimeError('working outside of application context')
+
+        try:
+            return self._cache_regions[region_name]
+        except KeyError:
+            return self._make_region(region_name)
+
+    def get_all_regions(self):
+        """
+        Method for getting all already configured cache regions.
+
+        :return dict: keys = region_names, values = <CacheRegion objects>
+
+        Will raise RunTimeError if call it before `init_app` method.
+        """
+        if isinstance(self._cache_regions, NotInitialized):
+            raise RuntimeError('working outside of application context')
+
+        return OrderedDict(
+            (region_name, self.get_region(region_name))
+            for region_name in self._region_specs
+        )
+
+    def get_region_decorator(self, region_name):
+        """
+        Method for getting already configured cache region_decorator.
+
+        :param region_name: Name for region from config (for example, 'hour').
+
+        :return <CacheRegion object>.cache_on_arguments():
+
+        Will raise RunTimeError if call it before `init_app` method.
+        """
+        if isinstance(self._cache_regions_decorators, NotInitialized):
+            raise RuntimeError('working outside of application context')
+
+        try:
+            return self._cache_regions_decorators[region_name]
+        except KeyError:
+            self._make_region(region_name)
+            return self._cache_regions_decorators[region_name]
+
+    def shutdown(self, wait=True):
+        """
+        Method for stopping background refresh-ahead and async threads.
+
+        :param wait: if True, waits for scheduled regenerations to finish.
+
+        Called automatically at interpreter exit and when `init_app`
+        reconfigures regions.
+        """
+        for runner in self._refresh_ahead_runners.values():
+            runner.shutdown(wait)
+
+        with self._async_executor_lock:
+            if self._async_executor is not None:
+                self._async_executor.shutdown(wait=wait)
+                self._async_executor = None
+
+    def _after_fork(self):
+        """
+        Called in a child process after `os.fork()`.
+
+        Regions configured in the parent (e.g. gunicorn master with
+        `preload_app = True`) share their backend clients' sockets with it,
+        so they are dropped and configured again on first use. Background
+        threads don't survive fork, so thread pools are dropped too.
+        Parent's clients aren't closed, they are still used by the parent.
+        """
+        self._regions_lock = Lock()
+        self._async_executor_lock = Lock()
+        self._async_executor = None
+        self._refresh_ahead_runners = dict()
+        self._cached_funcs.clear()
+        if not isinstance(self._cache_regions, NotInitialized):
+            self._cache_regions = dict()
+            self._cache_regions_decorators = dict()
+        for l1_proxy in self._l1_proxies.values():
+            l1_proxy.after_fork()
+        for circuit_breaker in self._circuit_breakers.values():
+            circuit_breaker.after_fork()
+        for region_stats in self._region_stats.values():
+            region_stats.after_fork()
+        self._profiles = dict()
+
+    def _get_async_executor(self):
+        with self._async_executor_lock:
+            if self._async_executor is None:
+                self._async_executor = ThreadPoolExecutor(
+                    max_workers=self._async_workers,
+                )
+            return self._async_executor
+
+    async def _run_async(self, func, *args, **kwargs):
+        """
+        Runs blocking `func` (cache server calls) in async executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_async_executor(), partial(func, *args, **kwargs)
+        )
+
+    def stats(self):
+        """
+        Method for getting statistics of all regions.
+
+        :return dict: keys = region_names, values = dicts with counters
+                      `hits`, `misses`, `regenerations`, `creation_seconds`,
+                      `bytes_read`, `bytes_written` (only bytes values are
+                      measured, see `serializer` region option),
+                      `stale_hits`, `stale_errors`, `breaker_trips`,
+                      `breaker_bypasses`, histograms `backend_get_seconds`,
+                      `backend_set_seconds`, `l1_hits`, `l1_misses` for
+                      regions with `l1_size` and `breaker_state` for
+                      regions with `circuit_breaker`.
+
+        Requires DOGPILE_CACHE_STATS.
+        """
+        result = dict()
+        for region_name, region_stats in self._region_stats.items():
+            region_result = result[region_name] = region_stats.snapshot()
+            if region_name in self._l1_proxies:
+                l1_stats = self._l1_proxies[region_name].stats()
+                region_result['l1_hits'] = l1_stats['hits']
+                region_result['l1_misses'] = l1_stats['misses']
+            if region_name in self._circuit_breakers:
+                region_result['breaker_state'] = (
+                    self._circuit_breakers[region_name].state
+                )
+
+        return result
+
+    def prometheus_metrics(self):
+        """
+        Method for getting `cache.stats()` in Prometheus text format.
+        """
+        lines = []
+        stats = sorted(self.stats().items())
+        counters = RegionStats.COUNTERS + ('l1_hits', 'l1_misses')
+        for name in counters:
+            metric = 'dogpile_cache_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+            for region_name, region_stats in stats:
+                if name in region_stats:
+                    lines.append('%s{region="%s"} %s' % (
+                        metric, region_name, region_stats[name],
+                    ))
+
+        metric = 'dogpile_cache_breaker_state'
+        lines.append('# TYPE %s gauge' % metric)
+        for region_name, region_stats in stats:
+            if 'breaker_state' in region_stats:
+                for state in CircuitBreakerProxy.STATES:
+                    lines.append('%s{region="%s",state="%s"} %d' % (
+                        metric, region_name, state,
+                        region_stats['breaker_state'] == state,
+                    ))
+
+        for name in RegionStats.HISTOGRAMS:
+            metric = 'dogpile_cache_%s' % name
+            lines.append('# TYPE %s histogram' % metric)
+            for region_name, region_stats in stats:
+                histogram = region_stats[name]
+                cumulative = 0
+                bounds = RegionStats.BUCKETS + ('+Inf',)
+                for bound, count in zip(bounds, histogram['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{region="%s",le="%s"} %s' % (
+                        metric, region_name, bound, cumulative,
+                    ))
+                lines.append('%s_sum{region="%s"} %s' % (
+                    metric, region_name, histogram['sum'],
+                ))
+                lines.append('%s_count{region="%s"} %s' % (
+                    metric, region_name, histogram['count'],
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+    def get_stats_blueprint(self, url='/metrics'):
+        """
+        Method for getting Flask blueprint serving `cache.stats()` in
+        Prometheus text format.
+
+        :param url: URL of metrics endpoint.
+
+        Example:
+
+            app.register_blueprint(cache.get_stats_blueprint())
+        """
+        blueprint = Blueprint('dogpile_cache', __name__)
+
+        @blueprint.route(url)
+        def metrics():
+            return Response(
+                self.prometheus_metrics(),
+                mimetype='text/plain; version=0.0.4',
+            )
+
+        return blueprint
+
+    def get_l1_stats(self):
+        """
+        Method for getting statistics of process-local tiers.
+
+        :return dict: keys = region_names with `l1_size` option,
+                      values = dicts with `hits`, `misses` and `size`.
+        """
+        return dict(
+            (region_name, l1_proxy.stats())
+            for region_name, l1_proxy in self._l1_proxies.items()
+        )
+
+    def _get_cached_func(self, func, region_name):
+        """
+        Returns dogpile's `cache_on_arguments` wrapper for `func`.
+
+        Wrappers are built once per (region_name, func) pair and reused until
+        regions are reconfigured by `init_app`.
+        """
+        key = (region_name, func)
+        try:
+            return self._cached_funcs[key]
+        except KeyError:
+            if not self._has_region(region_name):
+                raise KeyError(
+                    "You didn't specified region `%s`" % region_name
+                )
+            if getattr(func, self.FUNC_VIEW_ATTR, False):
+                self._check_view_region(region_name)
+
+            if iscoroutinefunction(func):
+                cached_func = self._make_async_func(func, region_name)
+                self._cached_funcs[key] = cached_func
+                return cached_func
+
+            region_stats = self._region_stats.get(region_name)
+            creator = func
+            if self._profile_rate:
+                creator = self._profile_creations(func, region_name)
+            if region_stats is not None:
+                creator = self._count_creations(creator, region_stats)
+
+            tags = getattr(func, self.FUNC_TAGS_ATTR, None)
+            stale_if_error = self._region_specs[region_name][
+                'options'
+            ].get('stale_if_error')
+            admission_policy = getattr(func, self.FUNC_ADMISSION_ATTR, None)
+            if admission_policy is None:
+                admission_policy = self._region_specs[region_name][
+                    'admission_policy'
+                ]
+            if tags is None:
+                decorator = self.get_region_decorator(region_name)
+                cache_creator = creator
+                if stale_if_error:
+                    cache_creator = self._make_stale_if_error_creator(
+                        func, cache_creator, region_name, stale_if_error
+                    )
+                if admission_policy is not None:
+                    cache_creator, should_cache_fn = (
+                        self._make_admission_creator(
+                            func, cache_creator, region_name,
+                            admission_policy,
+                        )
+                    )
+                    if stale_if_error:
+                        should_cache_fn = partial(
+                            self._is_admitted_and_not_stale, should_cache_fn
+                        )
+                        cache_creator.should_cache_fn = should_cache_fn
+                    decorator = self.get_region(
+                        region_name
+                    ).cache_on_arguments(should_cache_fn=should_cache_fn)
+
+                cached_func = decorator(cache_creator)
+                if cache_creator is not creator:
+                    # Explicit refresh always stores the value.
+                    cached_func.refresh = self.get_region_decorator(
+                        region_name
+                    )(creator).refresh
+
+                if admission_policy is not None:
+                    cached_func = self._count_frequency(
+                        cached_func, func, region_name
+                    )
+            else:
+                cached_func = self._make_tagged_func(
+                    func, creator, region_name, tags
+                )
+
+            if getattr(func, self.FUNC_HOT_ATTR, False):
+                cached_func = self._make_hot_func(
+                    cached_func, func, region_name
+                )
+
+            if region_name in self._single_flight_region_names:
+                cached_func = self._make_single_flight_func(
+                    cached_func, self._get_key_generator(func, region_name)
+                )
+
+            if region_stats is not None:
+                cached_func = self._count_calls(cached_func, region_stats)
+
+            if self._profile_rate:
+                cached_func = self._make_profiled_func(
+                    cached_func, func, region_name
+                )
+
+            self._cached_funcs[key] = cached_func
+            return cached_func
+
+    def _get_tag_versions(self, region, tag_keys, values=None):
+        """
+        Returns a tuple of current versions of tags. Versions of tags which
+        are not in cache yet are created. Versions don't expire.
+
+        :param values: Already fetched values of `tag_keys`.
+        """
+        if values is None:
+            values = region.get_multi(
+                tag_keys, expiration_time=self.NO_EXPIRATION
+            )
+
+        missing = dict(
+            (tag_key, uuid4().hex)
+            for tag_key, value in zip(tag_keys, values)
+            if value is NO_VALUE
+        )
+        if missing:
+            region.set_multi(missing)
+
+        return tuple(
+            missing.get(tag_key, value)
+            for tag_key, value in zip(tag_keys, values)
+        )
+
+    def _make_async_func(self, func, region_name):
+        """
+        Returns a wrapper for coroutine function decorated with
+        @cache.region(), compatible with dogpile's `cache_on_arguments`
+        wrapper except `refresh` (see `cache.refresh_async()`).
+
+        Cache server calls run in async executor. Concurrent awaiters of the
+        same key in the process, in any thread and event loop (Flask runs
+        every async view in its own loop), share one cache server `get` and,
+        if the value is missing, one call of `func`. Only the first of them
+        is counted in stats. If the first awaiter is cancelled, one of the
+        others takes over.
+        """
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
+        region_stats = self._region_stats.get(region_name)
+        in_flight = dict()
+        in_flight_lock = Lock()
+        leader_cancelled = object()
+
+        @wraps(func)
+        async def async_func(*args, **kwargs):
+            key = key_generator(*args, **kwargs)
+            while True:
+                # Registered before the first await, so concurrent calls
+                # can't miss it.
+                with in_flight_lock:
+                    future = in_flight.get(key)
+                    is_leader = future is None
+                    if is_leader:
+                        future = in_flight[key] = Future()
+                if is_leader:
+                    break
+
+                # Not a cache server call, so it's neither a hit nor a miss.
+                # Shielded, so cancelling this awaiter doesn't cancel others.
+                value = await asyncio.shield(asyncio.wrap_future(future))
+                if value is not leader_cancelled:
+                    return value
+
+            def release():
+                with in_flight_lock:
+                    del in_flight[key]
+
+            try:
+                value = await self._run_async(region.get, key)
+                if value is not NO_VALUE:
+                    if region_stats is not None:
+                        region_stats.incr('hits')
+                else:
+                    start = perf_counter()
+                    value = await func(*args, **kwargs)
+                    if region_stats is not None:
+                        region_stats.incr('misses')
+                        region_stats.incr('regenerations')
+                        region_stats.incr('creation_seconds',
+                                          perf_counter() - start)
+                    await self._run_async(region.set, key, value)
+            except asyncio.CancelledError:
+                release()
+                future.set_result(leader_cancelled)
+                raise
+            except BaseException as e:
+                release()
+                future.set_exception(e)
+                raise
+
+            release()
+            future.set_result(value)
+            return value
+
+        def refresh(*args, **kwargs):
+            raise TypeError(
+                'Use `cache.refresh_async()` for coroutine functions'
+            )
+
+        def invalidate(*args, **kwargs):
+            region.delete(key_generator(*args, **kwargs))
+
+        def set_(value, *args, **kwargs):
+            region.set(key_generator(*args, **kwargs), value)
+
+        def get(*args, **kwargs):
+            return region.get(key_generator(*args, **kwargs))
+
+        async_func.refresh = refresh
+        async_func.invalidate = invalidate
+        async_func.set = set_
+        async_func.get = get
+        async_func.original = func
+
+        return async_func
+
+    def _make_tagged_func(self, func, creator, region_name, tags):
+        """
+        Returns a wrapper for function decorated with @cache.region() with
+        `tags`, compatible with dogpile's `cache_on_arguments` wrapper.
+
+        Values are stored with versions of their tags and creation time. A
+        value is stale if any version has changed since, see
+        `cache.invalidate_tag()`. The value and versions of its tags are
+        fetched with one `get_multi` without expiration (versions never
+        expire), so expiration of the value is checked here.
+        """
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
+
+        def get_keys(args, kwargs):
+            key = key_generator(*args, **kwargs)
+            tag_keys = [self.TAG_KEY % tag for tag in tags(*args, **kwargs)]
+            return key, tag_keys
+
+        def has_versions(cached, versions):
+            # Tuples come back as lists from 'json' and 'msgpack'.
+            return tuple(cached[1]) == versions
+
+        def is_expired(cached):
+            return (
+                region.expiration_time is not None
+                and time() - cached[2] > region.expiration_time
+            )
+
+        @wraps(func)
+        def tagged_func(*args, **kwargs):
+            key, tag_keys = get_keys(args, kwargs)
+            values = region.get_multi(
+                [key] + tag_keys, expiration_time=self.NO_EXPIRATION
+            )
+            cached, versions = values[0], self._get_tag_versions(
+                region, tag_keys, values[1:]
+            )
+            if cached is not NO_VALUE:
+                if not has_versions(cached, versions):
+                    region.delete(key)
+                elif not is_expired(cached):
+                    return cached[0]
+
+            return region.get_or_create(
+                key, lambda: (creator(*args, **kwargs), versions, time())
+            )[0]
+
+        def refresh(*args, **kwargs):
+            key, tag_keys = get_keys(args, kwargs)
+            versions = self._get_tag_versions(region, tag_keys)
+            value = creator(*args, **kwargs)
+            region.set(key, (value, versions, time()))
+            return value
+
+        def invalidate(*args, **kwargs):
+            region.delete(key_generator(*args, **kwargs))
+
+        def set_(value, *args, **kwargs):
+            key, tag_keys = get_keys(args, kwargs)
+            versions = self._get_tag_versions(region, tag_keys)
+            region.set(key, (value, versions, time()))
+
+        def get(*args, **kwargs):
+            key, tag_keys = get_keys(args, kwargs)
+            values = region.get_multi(
+                [key] + tag_keys, expiration_time=self.NO_EXPIRATION
+            )
+            cached = values[0]
+            if (
+                cached is NO_VALUE
+                or not has_versions(cached, tuple(values[1:]))
+                or is_expired(cached)
+            ):
+                return NO_VALUE
+            return cached[0]
+
+        tagged_func.refresh = refresh
+        tagged_func.invalidate = invalidate
+        tagged_func.set = set_
+        tagged_func.get = get
+        tagged_func.original = func
+
+        return tagged_func
+
+    def _make_hot_func(self, cached_func, func, region_name):
+        """
+        Wraps dogpile's wrapper so keys of its calls are marked as hot in
+        regions with `sharding` option. Returns `cached_func` as is in
+        other regions.
+        """
+        region = self.get_region(region_name)
+        backend = region.actual_backend
+        if not isinstance(backend, ShardedBackend):
+            return cached_func
+
+        key_generator = self._get_key_generator(func, region_name)
+        key_mangler = region.key_mangler
+
+        @wraps(cached_func)
+        def hot_func(*args, **kwargs):
+            key = key_generator(*args, **kwargs)
+            if key_mangler:
+                key = key_mangler(key)
+            backend.mark_hot(key)
+            return cached_func(*args, **kwargs)
+
+        return hot_func
+
+    def _make_single_flight_func(self, cached_func, key_generator):
+        """
+        Wraps dogpile's wrapper so concurrent calls with the same cache key
+        wait for the first one and share its result.
+        """
+        in_flight = dict()
+        lock = Lock()
+
+        @wraps(cached_func)
+        def single_flight_func(*args, **kwargs):
+            key = key_generator(*args, **kwargs)
+            with lock:
+                future = in_flight.get(key)
+                if future is None:
+                    future = in_flight[key] = Future()
+                    is_leader = True
+                else:
+                    is_leader = False
+
+            if not is_leader:
+                return future.result()
+
+            try:
+                value = cached_func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(value)
+            finally:
+                with lock:
+                    del in_flight[key]
+
+            return value
+
+        return single_flight_func
+
+    def _make_stale_if_error_creator(self, func, creator, region_name,
+                                     stale_if_error):
+        """
+        Wraps `creator` so that if it raises an exception, the value in
+        cache is returned, unless it expired more than `stale_if_error`
+        seconds ago or region was invalidated after it was created.
+
+        Returned stale value isn't stored (see `_is_not_stale`), so it keeps
+        its creation time.
+        """
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
+        region_stats = self._region_stats.get(region_name)
+        region_timeout = self._region_specs[region_name]['timeout']
+        thread_local = self._local
+
+        @wraps(func)
+        def stale_if_error_creator(*args, **kwargs):
+            thread_local.stale = False
+            try:
+                return creator(*args, **kwargs)
+            except Exception:
+                cached = region.get_value_metadata(
+                    key_generator(*args, **kwargs), ignore_expiration=True
+                )
+                if (
+                    cached is None
+                    or cached.cached_time <
+                    time() - region_timeout - stale_if_error
+                    or region.region_invalidator.is_invalidated(
+                        cached.cached_time
+                    )
+                ):
+                    raise
+
+                log.warning('Serving stale value of `%s` in region `%s`',
+                            func.__name__, region_name, exc_info=True)
+                if region_stats is not None:
+                    region_stats.incr('stale_errors')
+                thread_local.stale = True
+                return cached.payload
+
+        return stale_if_error_creator
+
+    def _make_admission_policy(self, admission):
+        """
+        Returns `AdmissionPolicy` from dict of its params (or as is).
+        """
+        if isinstance(admission, AdmissionPolicy):
+            return admission
+        if not isinstance(admission, dict):
+            raise ValueError('`admission` must be dict or AdmissionPolicy')
+        try:
+            return AdmissionPolicy(**admission)
+        except TypeError as e:
+            raise ValueError('Wrong `admission`: %s' % e)
+
+    def _get_sketch(self, region_name):
+        try:
+            return self._sketches[region_name]
+        except KeyError:
+            return self._sketches.setdefault(region_name, FrequencySketch(
+                self._region_specs[region_name]['options'].get(
+                    'admission_sketch_width', 4096
+                )
+            ))
+
+    def _count_frequency(self, cached_func, func, region_name):
+        """
+        Wraps dogpile's wrapper so keys of its calls are counted in the
+        region's `FrequencySketch`.
+        """
+        key_generator = self._get_key_generator(func, region_name)
+        sketch = self._get_sketch(region_name)
+
+        @wraps(cached_func)
+        def frequency_counted(*args, **kwargs):
+            sketch.increment(key_generator(*args, **kwargs))
+            return cached_func(*args, **kwargs)
+
+        return frequency_counted
+
+    def _make_admission_creator(self, func, creator, region_name,
+                                admission_policy):
+        """
+        Returns (creator, should_cache_fn) pair. The creator measures
+        creation time and frequency of the key, `should_cache_fn` applies
+        `admission_policy` to them and serialized size of the value.
+
+        Values are measured in creator after `func` returns, so cached funcs
+        called by `func` don't affect them.
+        """
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
+        sketch = self._get_sketch(region_name)
+        region_stats = self._region_stats.get(region_name)
+        thread_local = self._local
+
+        @wraps(func)
+        def admission_creator(*args, **kwargs):
+            start = perf_counter()
+            value = creator(*args, **kwargs)
+            thread_local.admission = (
+                perf_counter() - start,
+                sketch.estimate(key_generator(*args, **kwargs)),
+            )
+            return value
+
+        def should_cache_fn(value):
+            creation_seconds, frequency = thread_local.admission
+            return self._is_admitted(region, admission_policy, region_stats,
+                                     value, creation_seconds, frequency)
+
+        # Used by `RefreshAheadRunner` for values regenerated in background.
+        admission_creator.should_cache_fn = should_cache_fn
+
+        return admission_creator, should_cache_fn
+
+    def _is_admitted(self, region, admission_policy, region_stats, value,
+                     creation_seconds, frequency):
+        """
+        Applies `admission_policy` to `value` and counts the decision.
+        """
+        size = None
+        if admission_policy.max_size is not None:
+            size = self._get_value_size(region, value)
+
+        reason = admission_policy(size, creation_seconds, frequency)
+        if region_stats is not None:
+            region_stats.incr(
+                'admissions' if reason is None else 'rejections_' + reason
+            )
+        return reason is None
+
+    def _get_value_size(self, region, value):
+        """
+        Returns serialized size of `value` in bytes.
+        """
+        if isinstance(value, (bytes, str)):
+            return len(value)
+        if region.serializer is not None:
+            return len(region.serializer(value))
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _is_admitted_and_not_stale(self, should_cache_fn, value):
+        not_stale = self._is_not_stale(value)
+        return should_cache_fn(value) and not_stale
+
+    def _is_not_stale(self, value):
+        """
+        dogpile's `should_cache_fn` rejecting values returned by
+        stale-if-error creators.
+        """
+        stale = getattr(self._local, 'stale', False)
+        self._local.stale = False
+        return not stale
+
+    def _count_creations(self, func, region_stats):
+        """
+        Wraps `func` so its calls are counted as regenerations.
+        """
+        thread_local = self._local
+
+        @wraps(func)
+        def creator(*args, **kwargs):
+            thread_local.created = True
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                region_stats.incr('regenerations')
+                region_stats.incr('creation_seconds', perf_counter() - start)
+
+        return creator
+
+    def _profile_creations(self, func, region_name):
+        """
+        Wraps `func` so creation time and value size of sampled calls are
+        passed to `_make_profiled_func` wrapper.
+        """
+        region = self.get_region(region_name)
+        thread_local = self._local
+
+        @wraps(func)
+        def creator(*args, **kwargs):
+            if not getattr(thread_local, 'profiling', False):
+                return func(*args, **kwargs)
+
+            start = perf_counter()
+            value = func(*args, **kwargs)
+            creation_seconds = perf_counter() - start
+            try:
+                size = self._get_value_size(region, value)
+            except Exception:
+                # Value isn't picklable, e.g. in dogpile.cache.memory.
+                size = None
+            thread_local.profiled_creation = (creation_seconds, size)
+            return value
+
+        return creator
+
+    def _make_profiled_func(self, cached_func, func, region_name):
+        """
+        Wraps cached func so DOGPILE_CACHE_PROFILE fraction of its calls
+        are recorded in `FunctionProfile` of `func`, see `cache.profile()`.
+        """
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
+        profile = self._profiles[(region_name, func)] = FunctionProfile()
+        rate = self._profile_rate
+        thread_local = self._local
+
+        @wraps(cached_func)
+        def profiled(*args, **kwargs):
+            if random.random() >= rate:
+                return cached_func(*args, **kwargs)
+
+            metadata = region.get_value_metadata(
+                key_generator(*args, **kwargs), ignore_expiration=True
+            )
+            profiling = getattr(thread_local, 'profiling', False)
+            thread_local.profiling = True
+            thread_local.profiled_creation = None
+            start = perf_counter()
+            try:
+                value = cached_func(*args, **kwargs)
+            finally:
+                thread_local.profiling = profiling
+            profile.record(
+                perf_counter() - start,
+                metadata is not None,
+                thread_local.profiled_creation,
+            )
+            return value
+
+        return profiled
+
+    def profile(self, min_calls=20):
+        """
+        Method for getting profiles of funcs decorated with @cache.region(),
+        requires DOGPILE_CACHE_PROFILE.
+
+        :param min_calls: Sampled calls needed to suggest changes.
+
+        :return list: dicts sorted by `cost_seconds`, most expensive first,
+                      with keys:
+                      `function`, `region`, `timeout`,
+                      `sampled_calls`, `calls` (estimated from sample rate),
+                      `calls_per_second`, `hit_ratio`, `expired_miss_ratio`
+                      (fraction of calls regenerating expired values),
+                      `creation_seconds` (dict with `mean`, `p50`, `p90`,
+                      `p99`, `max`), `hit_seconds` (mean duration of a call
+                      served from cache), `value_bytes` (mean size),
+                      `cpu_seconds` (estimated time spent in the func),
+                      `backend_seconds` (estimated time spent in cache),
+                      `cost_seconds` (their sum), `saved_seconds`
+                      (estimated time saved against uncached calls) and
+                      `suggestions` (list of str).
+        """
+        timeouts = dict(
+            (region_name, spec['timeout'])
+            for region_name, spec in self._region_specs.items()
+        )
+        rate = self._profile_rate or 1
+        now = time()
+        result = []
+        for (region_name, func), profile in list(self._profiles.items()):
+            snapshot = profile.snapshot()
+            if not snapshot['calls']:
+                continue
+
+            sampled_calls = snapshot['calls']
+            calls = sampled_calls / rate
+            hits = snapshot['hits'] / rate
+            creation_mean = hit_mean = None
+            if snapshot['misses']:
+                creation_mean = (
+                    snapshot['creation_seconds'] / snapshot['misses']
+                )
+            if snapshot['hits']:
+                hit_mean = snapshot['hit_seconds'] / snapshot['hits']
+
+            cpu_seconds = snapshot['creation_seconds'] / rate
+            backend_seconds = (
+                snapshot['hit_seconds'] + snapshot['miss_seconds']
+                - snapshot['creation_seconds']
+            ) / rate
+            saved_seconds = None
+            if creation_mean is not None and hit_mean is not None:
+                saved_seconds = hits * (creation_mean - hit_mean)
+
+            function_result = dict(
+                function='%s.%s' % (func.__module__, func.__qualname__),
+                region=region_name,
+                timeout=timeouts.get(region_name),
+                sampled_calls=sampled_calls,
+                calls=calls,
+                calls_per_second=calls / max(
+                    now - snapshot['started_at'], 1e-6
+                ),
+                hit_ratio=snapshot['hits'] / sampled_calls,
+                expired_miss_ratio=(
+                    snapshot['expired_misses'] / sampled_calls
+                ),
+                creation_seconds=dict(
+                    snapshot['creation_percentiles'], mean=creation_mean,
+                ),
+                hit_seconds=hit_mean,
+                value_bytes=(
+                    snapshot['value_bytes'] / snapshot['sized_values']
+                    if snapshot['sized_values'] else None
+                ),
+                cpu_seconds=cpu_seconds,
+                backend_seconds=backend_seconds,
+                cost_seconds=cpu_seconds + backend_seconds,
+                saved_seconds=saved_seconds,
+            )
+            function_result['suggestions'] = (
+                self._suggest(function_result, timeouts)
+                if sampled_calls >= min_calls else []
+            )
+            result.append(function_result)
+
+        result.sort(key=lambda item: item['cost_seconds'], reverse=True)
+        return result
+
+    def _suggest(self, function_result, timeouts):
+        """
+        Returns suggested changes of caching of a func profiled by
+        `cache.profile()`.
+        """
+        suggestions = []
+        region_name = function_result['region']
+        timeout = function_result['timeout']
+        creation_mean = function_result['creation_seconds']['mean']
+        hit_seconds = function_result['hit_seconds']
+
+        if (
+            creation_mean is not None and hit_seconds is not None
+            and hit_seconds >= creation_mean
+        ):
+            suggestions.append(
+                'cached calls take longer than the function itself '
+                '(%.2fms vs %.2fms): don\'t cache it' % (
+                    hit_seconds * 1000, creation_mean * 1000,
+                )
+            )
+            return suggestions
+
+        if function_result['expired_miss_ratio'] >= 0.1:
+            longer = sorted(
+                (region_timeout, name)
+                for name, region_timeout in timeouts.items()
+                if timeout is not None and region_timeout > timeout
+            )
+            message = '%d%% of calls regenerate expired values: ' % (
+                function_result['expired_miss_ratio'] * 100
+            )
+            if longer:
+                message += 'move it to region `%s` (%ds)' % (
+                    longer[0][1], longer[0][0],
+                )
+            else:
+                message += 'increase timeout of region `%s` above %ds' % (
+                    region_name, timeout,
+                )
+            suggestions.append(message)
+        elif function_result['hit_ratio'] < 0.5:
+            suggestions.append(
+                'hit ratio is %d%% and values rarely expire, so most '
+                'values are never reused: use `admission` with '
+                '`min_frequency` or don\'t cache it' % (
+                    function_result['hit_ratio'] * 100
+                )
+            )
+
+        value_bytes = function_result['value_bytes']
+        options = self._region_specs[region_name]['options']
+        if (
+            value_bytes is not None and value_bytes > 1000000
+            and not options.get('chunking')
+        ):
+            suggestions.append(
+                'values take %d bytes on average: enable `chunking` or '
+                '`compression`' % value_bytes
+            )
+
+        return suggestions
+
+    def get_profile_blueprint(self, url='/cache-profile'):
+        """
+        Method for getting Flask blueprint serving `cache.profile()` as
+        JSON, read by `flask dogpile-cache profile` command.
+
+        :param url: URL of profile endpoint.
+
+        Example:
+
+            app.register_blueprint(cache.get_profile_blueprint())
+        """
+        blueprint = Blueprint('dogpile_cache_profile', __name__)
+
+        @blueprint.route(url)
+        def profile():
+            return Response(
+                json.dumps(self.profile()), mimetype='application/json',
+            )
+
+        return blueprint
+
+    def _count_calls(self, cached_func, region_stats):
+        """
+        Wraps dogpile's wrapper so its calls are counted as hits or misses.
+        """
+        thread_local = self._local
+
+        @wraps(cached_func)
+        def counted(*args, **kwargs):
+            # Cached funcs called by the creator of another one reset the
+            # flag, so it's restored for the outer call.
+            created = getattr(thread_local, 'created', False)
+            thread_local.created = False
+            try:
+                value = cached_func(*args, **kwargs)
+                region_stats.incr(
+                    'misses' if thread_local.created else 'hits'
+                )
+            finally:
+                thread_local.created = created
+            return value
+
+        return counted
+
+    def _get_cached_func_for(self, func):
+        """
+        Returns dogpile's wrapper for function decorated with @cache.region().
+
+        Will raise AttributeError if `func` isn't decorated.
+        """
+        region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
+        func = getattr(func, self.FUNC_ORIGINAL_ATTR, func)
+
+        return self._get_cached_func(func, region_name)
+
+    def _get_key_generator(self, func, region_name):
+        """
+        Returns the key generator `cache_on_arguments` uses for `func`, so
+        other code paths produce exactly the same cache keys.
+        """
+        key = (region_name, func)
+        try:
+            return self._key_generators[key]
+        except KeyError:
+            region = self.get_region(region_name)
+            key_generator = region.function_key_generator(None, func)
+            self._key_generators[key] = key_generator
+            return key_generator
+
+    def region(self, name, tags=None, hot=False, admission=None):
+        """
+        CacheRegion decorator.
+
+        :param name: Region name from config['DOGPILE_CACHE_REGIONS'].
+
+        :param tags: Optional function which accepts decorated function
+                     arguments and returns a list of tags (str) of the value.
+                     See `cache.invalidate_tag()`.
+
+        :param hot: If True, values are replicated to several servers in
+                    regions with `sharding` option, see `ShardedBackend`.
+
+        :param admission: Optional `AdmissionPolicy` or dict of its params,
+                          overrides `admission` region option.
+
+        Example:
+
+            @cache.region('hour')
+            def cached_func(*args, **kwargs):
+                return args, kwargs
+
+            cached_value = cached_func()
+
+            @cache.region('hour', tags=lambda user_id: ['user:%s' % user_id])
+            def get_user_profile(user_id):
+                ...
+
+        Coroutine functions are supported too, awaited values are cached:
+
+            @cache.region('hour')
+            async def cached_coroutine_func(*args):
+                return await fetch(*args)
+        """
+        def decorator(func):
+            setattr(func, self.FUNC_REGION_NAME_ATTR, name)
+            if hot:
+                setattr(func, self.FUNC_HOT_ATTR, True)
+            if admission is not None:
+                setattr(func, self.FUNC_ADMISSION_ATTR,
+                        self._make_admission_policy(admission))
+            if tags is not None:
+                if iscoroutinefunction(func):
+                    raise ValueError(
+                        '`tags` are not supported for coroutine functions'
+                    )
+                setattr(func, self.FUNC_TAGS_ATTR, tags)
+            key = (name, func)
+
+            if iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    try:
+                        cached_func = self._cached_funcs[key]
+                    except KeyError:
+                        cached_func = self._get_cached_func(func, name)
+
+                    return await cached_func(*args, **kwargs)
+
+                setattr(async_wrapper, self.FUNC_ORIGINAL_ATTR, func)
+
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    cached_func = self._cached_funcs[key]
+                except KeyError:
+                    cached_func = self._get_cached_func(func, name)
+
+                if self._request_memo and has_request_context():
+                    return self._call_with_request_memo(
+                        key, cached_func, args, kwargs
+                    )
+
+                return cached_func(*args, **kwargs)
+
+            setattr(wrapper, self.FUNC_ORIGINAL_ATTR, func)
+
+            return wrapper
+
+        return decorator
+
+    def cached_view(self, region_name, vary_on=(), query_args=True):
+        """
+        Flask view decorator caching whole responses in a region.
+
+        :param region_name: Region name from config['DOGPILE_CACHE_REGIONS'].
+
+        :param vary_on: Names of request headers responses depend on. Their
+                        values are part of cache keys and they are listed
+                        in `Vary` response header.
 
-    def __init__(self, app=None, config=None, wrappers_debug=None,
-                 wrappers_production=None):
-        """
-        :param app: Flask app object.
+        :param query_args: Names of query args responses depend on. True (by
+                           default) for all query args, False for none.
 
-        :param config: Configuration dict.
+        Only responses of GET and HEAD requests with 200 status code, not
+        streamed, without `Set-Cookie` header, not marked `no-store` or
+        `private` in `Cache-Control` and not varying on headers other than
+        `vary_on` are cached. Responses of views which accessed the session
+        aren't cached either: they may differ for every user, while cache
+        keys don't include the cookie. Body, status and headers
+        are stored with `ETag` (unless the view sets it) and
+        `Last-Modified`. Requests with matching `If-None-Match` or
+        `If-Modified-Since` get 304 without body.
 
-            DOGPILE_CACHE_BACKEND
-                Optional. 'dogpile.cache.memcached' by default.
-                You can override it with other available backends from
-                dogpile.cache.
+        Regions with `refresh_ahead` or `stale_while_revalidate` options
+        can't be used, views need a request context to regenerate responses.
+        Regions with `json` serializer can't be used either, it can't store
+        bytes of response bodies.
 
-            DOGPILE_CACHE_URLS
-                Required if not declared for each region.
-                A list or tuple of cache servers' urls.
-                For example, ["127.0.0.1:11211"].
+        Cached responses are invalidated by path, query args and values of
+        `vary_on` headers, like funcs by their arguments. Omitted query and
+        headers stand for requests without them:
 
-            DOGPILE_CACHE_REGIONS
-                Required. A list or tuple of region_data_tuples. Each
-                region_data_tuple has from 2 to 4 elements:
-                1) region_name (str, required). For example, 'hour'.
-                2) region_timeout (int, required). For example, 3600.
-                3) region_backend (str, optional). If not declared takes
-                   its value from DOGPILE_CACHE_BACKEND.
-                4) region_urls (list or tuple, optional). If not declared
-                   takes its value from DOGPILE_CACHE_URLS.
-                5) region_arguments (dict, optional). See description bellow.
+            @app.route('/users/<int:user_id>')
+            @cache.cached_view('hour', vary_on=['Accept-Language'])
+            def user_page(user_id):
+                return render_template('user.html', user_id=user_id)
 
-            DOGPILE_CACHE_ARGUMENTS
-                Optional.  The structure here is passed directly to the
-                constructor of the class `CacheBackend` in use, though is
-                typically a dictionary.
+            cache.invalidate(user_page, '/users/42')
+            cache.invalidate(user_page, '/users/42', query=(('page', '2'),),
+                             headers=('en',))
+        """
+        vary_on = tuple(vary_on)
+        vary_on_lower = set(name.lower() for name in vary_on)
+        if (
+            not isinstance(self._cache_regions, NotInitialized)
+            and self._has_region(region_name)
+        ):
+            self._check_view_region(region_name)
 
-            The simplest config is:
-                DOGPILE_CACHE_URLS = ["127.0.0.1:11211"]
-                DOGPILE_CACHE_REGIONS = [
-                    ('hour', 3600),
-                    ('day', 3600 * 24),
+        def decorator(view):
+            def response_creator(path, query=(), headers=()):
+                response = current_app.make_response(
+                    view(**(request.view_args or {}))
+                )
+                cache_control = response.cache_control
+                if (
+                    response.status_code != 200
+                    or response.is_streamed
+                    or 'Set-Cookie' in response.headers
+                    or cache_control.no_store
+                    or cache_control.private
+                    or _is_session_accessed()
+                    or any(name.lower() not in vary_on_lower
+                           for name in response.vary)
+                ):
+                    raise NotCacheableResponse(
+                        response, request._get_current_object()
+                    )
+
+                body = response.get_data()
+                etag = response.get_etag()[0]
+                if etag is None:
+                    etag = hashlib.md5(body).hexdigest()
+                last_modified = response.last_modified
+                if last_modified is None:
+                    last_modified = int(time())
+                else:
+                    last_modified = int(last_modified.timestamp())
+                response_headers = [
+                    (name, value) for name, value in response.headers
+                    if name not in ('ETag', 'Last-Modified')
                 ]
+                return (body, response.status_code, response_headers, etag,
+                        last_modified)
 
-        :param wrappers_debug, wrappers_production:
-            A decorator class for altering the functionality of backends.
-            Example:
+            response_creator.__module__ = view.__module__
+            response_creator.__name__ = '%s.response' % view.__name__
+            response_creator.__qualname__ = response_creator.__name__
+            setattr(response_creator, self.FUNC_VIEW_ATTR, True)
+            cached_response_creator = self.region(region_name)(
+                response_creator
+            )
 
-                from dogpile.cache.proxy import ProxyBackend
+            @wraps(view)
+            def cached_view_func(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return view(*args, **kwargs)
 
-                class DebugProxy(ProxyBackend):
-                    @timer  # custom decorator that logs calls duration
-                    def get(self, key):
-                        return self.proxied.get(key)
+                if query_args is True:
+                    query = tuple(sorted(request.args.items(multi=True)))
+                elif query_args:
+                    query = tuple(
+                        (name, value) for name in sorted(query_args)
+                        for value in request.args.getlist(name)
+                    )
+                else:
+                    query = ()
+                headers = tuple(request.headers.get(name, '')
+                                for name in vary_on)
+                if not any(headers):
+                    # Same key as `cache.invalidate(view, path)`.
+                    headers = ()
 
-                    @timer
-                    def set(self, key, value):
-                        return self.proxied.set(key, value)
+                try:
+                    cached = cached_response_creator(
+                        request.path, query, headers
+                    )
+                except NotCacheableResponse as e:
+                    if e.request_object is request._get_current_object():
+                        return e.response
+                    # Shared by a concurrent request (`single_flight`).
+                    return view(*args, **kwargs)
 
-                    @timer
-                    def delete(self, key):
-                        return self.proxied.delete(key)
+                return self._make_view_response(cached, vary_on)
+
+            setattr(cached_view_func, self.FUNC_REGION_NAME_ATTR,
+                    region_name)
+            setattr(cached_view_func, self.FUNC_ORIGINAL_ATTR,
+                    response_creator)
 
+            return cached_view_func
+
+        return decorator
+
+    def _check_view_region(self, region_name):
         """
-        self.config = config
-        self.app = app
-        self._wrappers_debug = wrappers_debug
-        self._wrappers_production = wrappers_production
-        self._cache_regions = NotInitialized()
-        self._cache_regions_decorators = NotInitialized()
+        Raises ValueError if values of the region are regenerated in
+        background, where views of @cache.cached_view() can't run, or if
+        the region can't serialize bytes.
+        """
+        spec = self._region_specs[region_name]
+        if spec['max_age'] is not None:
+            raise ValueError(
+                "@cache.cached_view() can't use region `%s` with "
+                "`refresh_ahead` or `stale_while_revalidate`" % region_name
+            )
+        if spec['options'].get('serializer') == 'json':
+            raise ValueError(
+                "@cache.cached_view() can't use region `%s` with `json` "
+                "serializer" % region_name
+            )
 
-        if app is not None:
-            self.init_app(app, config)
+    def _make_view_response(self, cached, vary_on):
+        """
+        Returns response from value cached by @cache.cached_view(), or 304
+        response if request's conditional headers match it.
+        """
+        body, status, headers, etag, last_modified = cached
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since is not None:
+            not_modified = (
+                request.if_modified_since.timestamp() >= last_modified
+            )
+        else:
+            not_modified = False
 
-    def init_app(self, app, config=None, wrappers_debug=None,
-                 wrappers_production=None):
-        if not isinstance(config, (type(None), dict)):
-            raise ValueError("`config` must be dict or NoneType")
+        if not_modified:
+            response = Response(status=304)
+            cache_control = dict(headers).get('Cache-Control')
+            if cache_control:
+                response.headers['Cache-Control'] = cache_control
+        else:
+            response = Response(body, status=status, headers=headers)
 
-        if config is None:
-            config = self.config
-            if config is None:
-                config = app.config
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if vary_on:
+            response.vary.update(vary_on)
+        return response
 
-        config.setdefault('DOGPILE_CACHE_BACKEND', 'dogpile.cache.memcached')
-        config.setdefault('DOGPILE_CACHE_URLS', None)
-        config.setdefault('DOGPILE_CACHE_ARGUMENTS', {})
-        if not (
-            isinstance(config['DOGPILE_CACHE_REGIONS'], (list, tuple))
-            and config['DOGPILE_CACHE_REGIONS']
-        ):
-            raise ValueError('`DOGPILE_CACHE_REGIONS` must be list or tuple')
-        if not isinstance(config['DOGPILE_CACHE_ARGUMENTS'], dict):
-            raise ValueError('`DOGPILE_CACHE_ARGUMENTS` must be dict')
+    def _get_request_memo(self):
+        memo = getattr(g, '_dogpile_cache_memo', None)
+        if memo is None:
+            memo = g._dogpile_cache_memo = dict()
+            g._dogpile_cache_saved_calls = 0
+        return memo
 
-        wrappers_debug = wrappers_debug or self._wrappers_debug
-        wrappers_production = wrappers_production or self._wrappers_production
+    def _clear_request_memo(self, exception=None):
+        g.pop('_dogpile_cache_memo', None)
+        g.pop('_dogpile_cache_saved_calls', None)
 
-        self._set_cache_regions(
-            app=app,
-            config=config,
-            wrappers_debug=wrappers_debug,
-            wrappers_production=wrappers_production,
-        )
+    def _call_with_request_memo(self, key, cached_func, args, kwargs):
+        memo = self._get_request_memo()
+        if kwargs:
+            memo_key = key + (args, frozenset(kwargs.items()))
+        else:
+            memo_key = key + (args,)
+        try:
+            value = memo[memo_key]
+        except KeyError:
+            value = memo[memo_key] = cached_func(*args, **kwargs)
+        except TypeError:
+            # Unhashable arguments can't be memoized.
+            return cached_func(*args, **kwargs)
+        else:
+            g._dogpile_cache_saved_calls += 1
 
-    def _set_cache_regions(self, app, config, wrappers_debug,
-                           wrappers_production):
-        self._cache_regions = dict()
-        self._cache_regions_decorators = dict()
+        return value
 
-        for region_tuple in config['DOGPILE_CACHE_REGIONS']:
-            if len(region_tuple) < 2:
-                raise ValueError(
-                    '`DOGPILE_CACHE_REGIONS` tuple item length '
-                    'must be at least 2: region_name and region_timeout'
-                )
+    def _update_request_memo(self, func, args, kwargs=None, value=NO_VALUE):
+        """
+        Keeps request memo coherent after `set`, `refresh` or `invalidate`
+        of particular func. NO_VALUE drops memoized value.
 
-            region_name = region_tuple[0]
-            region_timeout = region_tuple[1]
+        Memoized values of func are dropped for all arguments, because the
+        same cache key may be memoized under different positional and
+        keyword arguments.
+        """
+        if not (self._request_memo and has_request_context()):
+            return
 
-            if len(region_tuple) > 2:
-                region_backend = region_tuple[2]
-            elif config['DOGPILE_CACHE_BACKEND']:
-                region_backend = config['DOGPILE_CACHE_BACKEND']
-            else:
-                raise ValueError(
-                    '`DOGPILE_CACHE_BACKEND` must be specified '
-                    'or not initialized at all (for default value)'
-                )
+        key = (
+            getattr(func, self.FUNC_REGION_NAME_ATTR),
+            getattr(func, self.FUNC_ORIGINAL_ATTR, func),
+        )
+        memo = self._get_request_memo()
+        for memo_key in list(memo):
+            if memo_key[:2] == key:
+                del memo[memo_key]
 
-            if len(region_tuple) > 3:
-                region_urls = region_tuple[3]
-            elif config['DOGPILE_CACHE_URLS']:
-                region_urls = config['DOGPILE_CACHE_URLS']
+        if value is not NO_VALUE:
+            if kwargs:
+                memo_key = key + (args, frozenset(kwargs.items()))
             else:
-                raise ValueError("`DOGPILE_CACHE_URLS` must be specified")
+                memo_key = key + (args,)
+            try:
+                memo[memo_key] = value
+            except TypeError:
+                pass
 
-            if len(region_tuple) > 4:
-                region_arguments = region_tuple[4]
-                if not isinstance(region_arguments, dict):
-                    raise ValueError('`regions_arguments` must be dict')
-            else:
-                region_arguments = config['DOGPILE_CACHE_ARGUMENTS']
+    def get_request_stats(self):
+        """
+        Method for getting statistics of request memo for current request.
 
-            arguments = dict(url=region_urls)
-            arguments.update(region_arguments)
+        :return dict: `saved_calls` - number of calls served from request memo
+                      instead of cache server, `size` - number of memoized
+                      values.
+        """
+        if not (self._request_memo and has_request_context()):
+            return dict(saved_calls=0, size=0)
 
-            def key_mangler(key):
-                func, args = key.split('|', 1)
-                return '%s|%s' % (func, md5(args.encode('utf-8')).hexdigest())
+        memo = self._get_request_memo()
+        return dict(saved_calls=g._dogpile_cache_saved_calls, size=len(memo))
 
-            region = make_region(key_mangler=key_mangler).configure(
-                backend=region_backend,
-                expiration_time=region_timeout,
-                arguments=arguments,
-                wrap=wrappers_debug if app.debug else wrappers_production,
-            )
-            region_decorator = region.cache_on_arguments()
+    def prefetch(self, func, args_list):
+        """
+        Method for loading values of particular func for many arguments into
+        request memo with one `get_multi` call.
 
-            self._cache_regions[region_name] = region
-            self._cache_regions_decorators[region_name] = region_decorator
+        :param func: Function, decorated with @cache.region().
 
-        if not hasattr(app, 'extensions'):
-            app.extensions = {}
+        :param args_list: A list of tuples with decorated function arguments.
 
-        app.extensions['dogpile_cache'] = self
+        Calls of `func` with these arguments made later in the same request
+        are served from request memo. Requires DOGPILE_CACHE_REQUEST_MEMO.
 
-    def get_region(self, region_name):
+        Example:
+
+            cache.prefetch(cached_func, [(user.id,) for user in users])
+            return render_template('users.html', users=users)
         """
-        Method for getting already configured cache region.
+        args_list = [tuple(args) for args in args_list]
+        values = self.get_many(func, args_list)
+        if not (self._request_memo and has_request_context()):
+            return values
 
-        :param region_name: Name for region from config (for example, 'hour').
+        key = (
+            getattr(func, self.FUNC_REGION_NAME_ATTR),
+            getattr(func, self.FUNC_ORIGINAL_ATTR, func),
+        )
+        memo = self._get_request_memo()
+        for args, value in zip(args_list, values):
+            try:
+                memo[key + (args,)] = value
+            except TypeError:
+                pass
 
-        :return <CacheRegion object>:
+        return values
 
-        Will raise RunTimeError if call it before `init_app` method.
+    @staticmethod
+    def _check_not_coroutine_function(func, method_name):
+        if iscoroutinefunction(func):
+            raise TypeError(
+                '`cache.%s()` does not support coroutine functions, await '
+                'them one by one instead' % method_name
+            )
+
+    def get_many(self, func, args_list, batch_func=None):
         """
-        if isinstance(self._cache_regions, NotInitialized):
-            raise RuntimeError('working outside of application context')
+        Method for getting cached values of particular func for many
+        arguments at once.
+
+        :param func: Function, decorated with @cache.region().
 
-        return self._cache_regions[region_name]
+        :param args_list: A list of tuples with decorated function arguments.
 
-    def get_all_regions(self):
-        """
-        Method for getting all already configured cache regions.
+        :param batch_func: Optional function that accepts a list of argument
+                           tuples and returns a list of values in the same
+                           order. It's called once for all missed values.
+                           By default `func` is called for each of them.
 
-        :return dict: keys = region_names, values = <CacheRegion objects>
+        :return list: Values in the order of `args_list`.
 
-        Will raise RunTimeError if call it before `init_app` method.
+        All values are fetched from cache server with one `get_multi` call
+        and all computed values are stored with one `set_multi` call. Cache
+        keys are the same as for calling `func` directly.
+
+        Funcs decorated with `tags` are called for each arguments tuple.
+        Coroutine functions are not supported (TypeError is raised), so
+        they can't be used with `cache.prefetch()` and `cache.warm()` too.
+
+        Values are stored subject to `admission` of the func or region.
+        Creation time of values computed by `batch_func` is averaged over
+        the batch.
+
+        Example:
+
+            values = cache.get_many(cached_func, [(1,), (2,), (3,)])
         """
-        if isinstance(self._cache_regions, NotInitialized):
-            raise RuntimeError('working outside of application context')
+        region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
+        func = getattr(func, self.FUNC_ORIGINAL_ATTR, func)
+        self._check_not_coroutine_function(func, 'get_many')
+        if getattr(func, self.FUNC_TAGS_ATTR, None) is not None:
+            cached_func = self._get_cached_func(func, region_name)
+            return [cached_func(*args) for args in args_list]
 
-        return self._cache_regions
+        region = self.get_region(region_name)
+        key_generator = self._get_key_generator(func, region_name)
 
-    def get_region_decorator(self, region_name):
+        args_list = [tuple(args) for args in args_list]
+        keys = [key_generator(*args) for args in args_list]
+        args_by_key = dict(zip(keys, args_list))
+
+        region_stats = self._region_stats.get(region_name)
+        missed_count = [0]
+
+        admission_policy = getattr(func, self.FUNC_ADMISSION_ATTR, None)
+        if admission_policy is None:
+            admission_policy = self._region_specs[region_name][
+                'admission_policy'
+            ]
+        should_cache_fn = None
+        # id() of created values -> [(creation_seconds, frequency)], in the
+        # order dogpile passes them to `should_cache_fn`.
+        admission_args = dict()
+        if admission_policy is not None:
+            sketch = self._get_sketch(region_name)
+            for key in keys:
+                sketch.increment(key)
+
+            def should_cache_fn(value):
+                creation_seconds, frequency = admission_args[id(value)].pop(0)
+                return self._is_admitted(
+                    region, admission_policy, region_stats, value,
+                    creation_seconds, frequency,
+                )
+
+        def create(missed_keys, missed_args):
+            if batch_func is not None:
+                start = perf_counter()
+                values = batch_func(missed_args)
+                creation_times = (
+                    [(perf_counter() - start) / max(len(missed_args), 1)]
+                    * len(missed_args)
+                )
+            else:
+                values = []
+                creation_times = []
+                for args in missed_args:
+                    start = perf_counter()
+                    values.append(func(*args))
+                    creation_times.append(perf_counter() - start)
+            if should_cache_fn is not None:
+                for key, value, creation_seconds in zip(
+                    missed_keys, values, creation_times
+                ):
+                    admission_args.setdefault(id(value), []).append(
+                        (creation_seconds, sketch.estimate(key))
+                    )
+            return values
+
+        def creator(*missed_keys):
+            missed_args = [args_by_key[key] for key in missed_keys]
+            missed_count[0] = len(missed_args)
+            start = perf_counter()
+            try:
+                return create(missed_keys, missed_args)
+            finally:
+                if region_stats is not None:
+                    region_stats.incr('regenerations', len(missed_args))
+                    region_stats.incr('creation_seconds',
+                                      perf_counter() - start)
+
+        values = region.get_or_create_multi(
+            keys, creator, should_cache_fn=should_cache_fn
+        )
+        if region_stats is not None:
+            region_stats.incr('misses', missed_count[0])
+            region_stats.incr('hits', len(args_by_key) - missed_count[0])
+
+        return values
+
+    def warmer(self, func):
         """
-        Method for getting already configured cache region_decorator.
+        Decorator for registering arguments generator of particular func for
+        `cache.warm()` and `flask dogpile-cache warm` command.
 
-        :param region_name: Name for region from config (for example, 'hour').
+        :param func: Function, decorated with @cache.region().
 
-        :return <CacheRegion object>.cache_on_arguments():
+        Example:
 
-        Will raise RunTimeError if call it before `init_app` method.
+            @cache.warmer(cached_func)
+            def cached_func_args():
+                return [(user.id,) for user in User.query]
         """
-        if isinstance(self._cache_regions_decorators, NotInitialized):
-            raise RuntimeError('working outside of application context')
+        getattr(func, self.FUNC_REGION_NAME_ATTR)
+        self._check_not_coroutine_function(
+            getattr(func, self.FUNC_ORIGINAL_ATTR, func), 'warmer',
+        )
+
+        def decorator(args_generator):
+            self._warmers.append((func, args_generator))
+            return args_generator
 
-        return self._cache_regions_decorators[region_name]
+        return decorator
 
-    def region(self, name):
+    def warm(self, regions=None, batch_size=100, concurrency=1,
+             rate_limit=None, progress=None):
         """
-        CacheRegion decorator.
+        Method for populating cache with values of funcs registered with
+        @cache.warmer().
 
-        :param name: Region name from config['DOGPILE_CACHE_REGIONS'].
+        :param regions: Optional list of region names to warm up.
 
-        Example:
+        :param batch_size: Number of values fetched and stored with one
+                           `get_multi` and `set_multi` call.
 
-            @cache.region('hour')
-            def cached_func(*args):
-                return args
+        :param concurrency: Number of threads computing batches.
 
-            cached_value = cached_func()
+        :param rate_limit: Optional max number of values per second.
+
+        :param progress: Optional function called with (func, values_count)
+                         after func is warmed up.
+
+        :return dict: keys = region_names, values = dicts with `values`
+                      (number of values) and `seconds` (time taken).
+
+        Values already in cache are not recomputed (see `cache.get_many`).
         """
-        def decorator(func):
-            setattr(func, self.FUNC_REGION_NAME_ATTR, name)
+        app = current_app._get_current_object() if has_app_context() else None
 
-            @wraps(func)
-            def wrapper(*args):
-                if name in self._cache_regions:
-                    cache_decorator = self.get_region_decorator(name)
-                    return cache_decorator(func)(*args)
-                else:
-                    raise KeyError("You didn't specified region `%s`" % name)
+        def warm_batch(func, batch):
+            if app is None:
+                return self.get_many(func, batch)
+            with app.app_context():
+                return self.get_many(func, batch)
 
-            return wrapper
+        result = dict()
+        started = perf_counter()
+        submitted = [0]
 
-        return decorator
+        def submit(executor, func, batch):
+            if rate_limit:
+                delay = submitted[0] / rate_limit - (perf_counter() - started)
+                if delay > 0:
+                    sleep(delay)
+            submitted[0] += len(batch)
+            return executor.submit(warm_batch, func, batch)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for func, args_generator in self._warmers:
+                region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
+                if regions is not None and region_name not in regions:
+                    continue
+
+                func_started = perf_counter()
+                futures = []
+                values_count = 0
+                batch = []
+                for args in args_generator():
+                    batch.append(tuple(args))
+                    if len(batch) >= batch_size:
+                        futures.append(submit(executor, func, batch))
+                        values_count += len(batch)
+                        batch = []
+                if batch:
+                    futures.append(submit(executor, func, batch))
+                    values_count += len(batch)
+
+                for future in futures:
+                    future.result()
+
+                region_result = result.setdefault(
+                    region_name, dict(values=0, seconds=0.0)
+                )
+                region_result['values'] += values_count
+                region_result['seconds'] += perf_counter() - func_started
+                if progress is not None:
+                    progress(func, values_count)
+
+        return result
 
     def invalidate_region(self, region_name, hard=True):
         """
@@ -268,6 +3902,36 @@ class DogpileCache(object):
         region = self.get_region(region_name)
         region.invalidate(hard)
 
+        if self._request_memo and has_request_context():
+            memo = self._get_request_memo()
+            for memo_key in list(memo):
+                if memo_key[0] == region_name:
+                    del memo[memo_key]
+
+        if region_name in self._l1_proxies:
+            self._l1_proxies[region_name].clear()
+
+    def invalidate_tag(self, tag):
+        """
+        Method for invalidating cache for all values of funcs decorated with
+        @cache.region(tags=...) having particular tag.
+
+        :param tag: Tag (str).
+
+        Only new version of the tag is stored (one `set` call per region),
+        values become stale when they are read next time. Versions are
+        stored in every region, so tags can be invalidated by any process
+        with the same config, e.g. `flask shell` or a task worker, even if
+        it hasn't imported the tagged funcs.
+
+        Example:
+
+            cache.invalidate_tag('user:42')
+        """
+        for region_name in self._region_specs:
+            region = self.get_region(region_name)
+            region.set(self.TAG_KEY % tag, uuid4().hex)
+
     def invalidate_all_regions(self, hard=True):
         """
         Method for invalidation cache for all funcs decorated with
@@ -285,49 +3949,48 @@ class DogpileCache(object):
         for region_name in self.get_all_regions().keys():
             self.invalidate_region(region_name, hard)
 
-    def invalidate(self, func, *args):
+    def invalidate(self, func, *args, **kwargs):
         """
         Method for invalidating cache for particular func.
 
         :param func: Function, decorated with @cache.region().
 
-        :param *args: Decorated function arguments.
+        :param *args, **kwargs: Decorated function arguments.
 
         Example:
 
             cache.invalidate(cached_func_without_args)
-            cache.invalidate(cached_func_with_args, *args)
+            cache.invalidate(cached_func_with_args, *args, **kwargs)
         """
-        region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
-        decorator = self.get_region_decorator(region_name)
-        func = decorator(func)
+        self._update_request_memo(func, args, kwargs)
+        func = self._get_cached_func_for(func)
 
-        return func.invalidate(*args)
+        return func.invalidate(*args, **kwargs)
 
-    def refresh(self, func, *args):
+    def refresh(self, func, *args, **kwargs):
         """
         Method for refreshing cache for particular func.
 
         :param func: Function, decorated with @cache.region().
 
-        :param *args: Decorated function arguments.
+        :param *args, **kwargs: Decorated function arguments.
 
         Example:
 
             cache.refresh(cached_func_without_args)
-            cache.refresh(cached_func_with_args, *args)
+            cache.refresh(cached_func_with_args, *args, **kwargs)
 
         You must understand that refreshing func do not call regenerating cache
         for func. If cache exists it does nothing. If cache does not exist it
         will compute (create) new cache value and store it to cache server.
         """
-        region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
-        decorator = self.get_region_decorator(region_name)
-        func = decorator(func)
+        cached_func = self._get_cached_func_for(func)
+        value = cached_func.refresh(*args, **kwargs)
+        self._update_request_memo(func, args, kwargs, value)
 
-        return func.refresh(*args)
+        return value
 
-    def set(self, func, value, *args):
+    def set(self, func, value, *args, **kwargs):
         """
         Method for setting custom cache value for particular func.
 
@@ -335,15 +3998,124 @@ class DogpileCache(object):
 
         :param value: Value to store.
 
-        :param *args: Decorated function arguments.
+        :param *args, **kwargs: Decorated function arguments.
 
         Example:
 
             cache.set(cached_func_without_args, 'value')
-            cache.set(cached_func_with_args, 'value', *args)
+            cache.set(cached_func_with_args, 'value', *args, **kwargs)
         """
-        region_name = getattr(func, self.FUNC_REGION_NAME_ATTR)
-        decorator = self.get_region_decorator(region_name)
-        func = decorator(func)
+        cached_func = self._get_cached_func_for(func)
+        cached_func.set(value, *args, **kwargs)
+        self._update_request_memo(func, args, kwargs, value)
+
+    async def invalidate_async(self, func, *args, **kwargs):
+        """
+        Awaitable `cache.invalidate()`.
+        """
+        await self._run_async(self.invalidate, func, *args, **kwargs)
+
+    async def refresh_async(self, func, *args, **kwargs):
+        """
+        Awaitable `cache.refresh()`. Supports coroutine functions.
+        """
+        original = getattr(func, self.FUNC_ORIGINAL_ATTR, func)
+        if not iscoroutinefunction(original):
+            return await self._run_async(self.refresh, func, *args, **kwargs)
+
+        value = await original(*args, **kwargs)
+        await self.set_async(func, value, *args, **kwargs)
+        return value
+
+    async def set_async(self, func, value, *args, **kwargs):
+        """
+        Awaitable `cache.set()`.
+        """
+        await self._run_async(self.set, func, value, *args, **kwargs)
+
+
+cli = AppGroup('dogpile-cache', help='Flask-Dogpile-Cache commands.')
+
+
+@cli.command('warm')
+@click.option('--region', 'regions', multiple=True,
+              help='Region to warm up. All regions by default.')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Values per get_multi/set_multi call.')
+@click.option('--concurrency', default=1, show_default=True,
+              help='Threads computing batches.')
+@click.option('--rate-limit', type=float, default=None,
+              help='Max values per second.')
+def warm_command(regions, batch_size, concurrency, rate_limit):
+    """Populate cache with values of funcs registered with
+    @cache.warmer()."""
+    cache = current_app.extensions['dogpile_cache']
+
+    def progress(func, values_count):
+        click.echo('%s.%s: %d values' % (
+            func.__module__, func.__name__, values_count,
+        ))
+
+    result = cache.warm(
+        regions=regions or None,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        rate_limit=rate_limit,
+        progress=progress,
+    )
+    for region_name, region_result in sorted(result.items()):
+        click.echo('Region `%s`: %d values in %.2fs' % (
+            region_name, region_result['values'], region_result['seconds'],
+        ))
 
-        return func.set(value, *args)
+
+@cli.command('profile')
+@click.argument('url')
+@click.option('--region', 'regions', multiple=True,
+              help='Region to report. All regions by default.')
+@click.option('--limit', type=int, default=None,
+              help='Max functions to report.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print the report as JSON.')
+def profile_command(url, regions, limit, as_json):
+    """Report profiles of funcs decorated with @cache.region() of the app
+    serving `cache.get_profile_blueprint()` at URL (each process profiles
+    its own calls), most expensive first."""
+    with urlopen(url) as response:
+        report = json.loads(response.read().decode('utf-8'))
+
+    if regions:
+        report = [item for item in report if item['region'] in regions]
+    report = report[:limit]
+    if as_json:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+        return
+
+    def ms(seconds):
+        return '-' if seconds is None else '%.2fms' % (seconds * 1000)
+
+    for item in report:
+        click.echo('%s (region `%s`, %ss)' % (
+            item['function'], item['region'], item['timeout'],
+        ))
+        click.echo(
+            '  %.1f calls/s, hit ratio %.1f%%, cost %.2fs (cpu %.2fs, '
+            'backend %.2fs), saved %s' % (
+                item['calls_per_second'], item['hit_ratio'] * 100,
+                item['cost_seconds'], item['cpu_seconds'],
+                item['backend_seconds'],
+                '-' if item['saved_seconds'] is None
+                else '%.2fs' % item['saved_seconds'],
+            )
+        )
+        creation = item['creation_seconds']
+        click.echo(
+            '  creation mean %s, p50 %s, p99 %s; hit %s; value %s' % (
+                ms(creation['mean']), ms(creation['p50']),
+                ms(creation['p99']), ms(item['hit_seconds']),
+                '-' if item['value_bytes'] is None
+                else '%d bytes' % item['value_bytes'],
+            )
+        )
+        for suggestion in item['suggestions']:
+            click.echo('  * %s' % suggestion)
@@ -1,9 +1,31 @@
 from __future__ import with_statement
 
+import asyncio
+import gc
+import os
 import sys
+import tempfile
+import threading
+import time
 from copy import deepcopy
-from flask import Flask
-from flask.ext.dogpile_cache import DogpileCache
+from flask import Flask, current_app, make_response, request, session
+from dataclasses import dataclass
+from dogpile.cache.api import CacheBackend, CantDeserializeException, NO_VALUE
+from flask.ext.dogpile_cache import (
+    AdmissionPolicy,
+    ChunkingProxy,
+    CircuitBreakerProxy,
+    CompressionProxy,
+    DogpileCache,
+    FrequencySketch,
+    KeyMangler,
+    make_serializer,
+    RegionStats,
+    ShardedBackend,
+    signature_key_generator,
+    typed_to_str,
+)
+from hashlib import md5
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -132,6 +154,1097 @@ class DogpileCacheTest(unittest.TestCase):
 
         self.assertRaises(KeyError, func)
 
+    def test_cached_func_wrapper_is_reused(self):
+        get_cached_func = self.cache._get_cached_func_for
+        cached_func = get_cached_func(self.func_cached_for_hour)
+        self.assertIs(get_cached_func(self.func_cached_for_hour), cached_func)
+
+        self.cache.init_app(self.app, self.config)
+        self.assertIsNot(get_cached_func(self.func_cached_for_hour),
+                         cached_func)
+        self.assertEqual(self.func_cached_for_hour(777),
+                         self.func_cached_for_hour_value + 777)
+
+    def test_l1_cache(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'l1_size': 2}
+        cache = DogpileCache(self.app, config)
+
+        calls = []
+
+        @cache.region('hour')
+        def l1_func(a):
+            calls.append(a)
+            return [a]
+
+        cache.invalidate_all_regions()
+        value = l1_func(1)
+        self.assertIs(l1_func(1), value)
+        self.assertEqual(cache.get_l1_stats()['hour']['hits'], 1)
+
+        cache.set(l1_func, [2], 1)
+        self.assertEqual(l1_func(1), [2])
+        cache.invalidate(l1_func, 1)
+        self.assertEqual(l1_func(1), [1])
+        self.assertEqual(calls, [1, 1])
+
+        # Invalidated values aren't served from the local tier.
+        cache.get_region('hour').invalidate()
+        hits = cache.get_l1_stats()['hour']['hits']
+        self.assertEqual(l1_func(1), [1])
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(cache.get_l1_stats()['hour']['hits'], hits)
+
+        l1_func(2)
+        l1_func(3)
+        self.assertEqual(cache.get_l1_stats()['hour']['size'], 2)
+
+        cache.invalidate_region('hour')
+        self.assertEqual(cache.get_l1_stats()['hour']['size'], 0)
+
+    def test_get_many(self):
+        self.clean_up_cache()
+        calls = []
+
+        @self.cache.region('hour')
+        def func(a):
+            calls.append(a)
+            return a * 2
+
+        self.assertEqual(func(1), 2)
+        self.assertEqual(self.cache.get_many(func, [(1,), (2,), (3,)]),
+                         [2, 4, 6])
+        self.assertEqual(calls, [1, 2, 3])
+
+        self.cache.set(func, 'custom', 2)
+        self.assertEqual(self.cache.get_many(func, [(2,), (3,), (2,)]),
+                         ['custom', 6, 'custom'])
+
+        def batch_func(args_list):
+            calls.append(args_list)
+            return [a * 3 for a, in args_list]
+
+        self.assertEqual(
+            self.cache.get_many(func, [(3,), (4,), (5,)], batch_func),
+            [6, 12, 15],
+        )
+        self.assertEqual(calls[-1], [(4,), (5,)])
+        self.assertEqual(func(5), 15)
+
+    def test_request_memo(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REQUEST_MEMO'] = True
+        cache = DogpileCache(self.app, config)
+        calls = []
+
+        @cache.region('hour')
+        def func(a):
+            calls.append(a)
+            return [a]
+
+        cache.invalidate_all_regions()
+        with self.app.test_request_context():
+            value = func(1)
+            self.assertIs(func(1), value)
+            self.assertIs(func(1), value)
+            self.assertEqual(cache.get_request_stats(),
+                             dict(saved_calls=2, size=1))
+
+            cache.set(func, [2], 1)
+            self.assertEqual(func(1), [2])
+            cache.invalidate(func, 1)
+            self.assertEqual(func(1), [1])
+
+            cache.prefetch(func, [(2,), (3,)])
+            self.assertEqual(func(3), [3])
+            self.assertEqual(calls, [1, 1, 2, 3])
+
+        with self.app.test_request_context():
+            self.assertEqual(cache.get_request_stats(),
+                             dict(saved_calls=0, size=0))
+
+    def test_refresh_ahead(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [('second', 1)]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'refresh_ahead': 0.5}
+        cache = DogpileCache(self.app, config)
+        calls = []
+
+        @cache.region('second')
+        def func():
+            calls.append(current_app.name)
+            return len(calls)
+
+        cache.invalidate_all_regions()
+        with self.app.app_context():
+            self.assertEqual(func(), 1)
+            time.sleep(0.6)
+            self.assertEqual(func(), 1)
+            cache.shutdown()
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(func(), 2)
+
+            time.sleep(1.1)
+            self.assertEqual(func(), 3)
+
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'refresh_ahead': 1}
+        self.assertRaises(ValueError, DogpileCache, self.app, config)
+
+    def test_serializer_and_compression(self):
+        for serializer in ('pickle', 'json'):
+            for compression in ('zlib', 'lzma'):
+                config = deepcopy(self.config)
+                config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+                    'serializer': serializer,
+                    'compression': compression,
+                    'compression_threshold': 100,
+                }
+                cache = DogpileCache(self.app, config)
+
+                @cache.region('hour')
+                def codec_func(codec, size):
+                    return {'value': 'x' * size}
+
+                codec = '%s-%s' % (serializer, compression)
+                cache.invalidate_all_regions()
+                for size in (1, 1000):
+                    self.assertEqual(codec_func(codec, size),
+                                     {'value': 'x' * size})
+                    self.assertEqual(codec_func(codec, size),
+                                     {'value': 'x' * size})
+                cache.invalidate(codec_func, codec, 1)
+                cache.invalidate(codec_func, codec, 1000)
+
+        # Values stored with other serializer are missing, not errors.
+        calls = []
+        cache_dict = dict()
+        for serializer in ('pickle', 'json', 'pickle'):
+            config = deepcopy(self.config)
+            config['DOGPILE_CACHE_REGIONS'] = [
+                ('hour', 3600, 'dogpile.cache.memory', [],
+                 {'cache_dict': cache_dict}),
+            ]
+            config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+                'serializer': serializer,
+            }
+            cache = DogpileCache(self.app, config)
+
+            @cache.region('hour')
+            def legacy_func():
+                calls.append(serializer)
+                return {'value': serializer}
+
+            self.assertEqual(legacy_func(), {'value': serializer})
+        self.assertEqual(calls, ['pickle', 'json', 'pickle'])
+
+        serializer, deserializer = make_serializer('json')
+        self.assertRaises(CantDeserializeException, deserializer, b'\x80')
+        serializer, deserializer = make_serializer('pickle')
+        self.assertRaises(CantDeserializeException, deserializer, b'{}')
+
+    def test_compression_proxy(self):
+        proxy = CompressionProxy('zlib', threshold=10)
+        self.assertEqual(proxy.compress(b'short'), b'-short')
+        data = b'long' * 100
+        self.assertEqual(proxy.compress(data)[:1], b'z')
+        self.assertEqual(proxy.decompress(proxy.compress(data)), data)
+        self.assertEqual(
+            proxy.decompress(CompressionProxy('lzma', 10).compress(data)),
+            data,
+        )
+        self.assertIs(proxy.decompress(b'zbroken'), NO_VALUE)
+        self.assertIs(proxy.decompress(object()), NO_VALUE)
+
+        self.assertRaises(ValueError, CompressionProxy, 'not_existent')
+        self.assertRaises(ValueError, make_serializer, 'not_existent')
+
+    def test_circuit_breaker_proxy(self):
+        class Backend(CacheBackend):
+            calls = 0
+            failing = True
+
+            def __init__(self):
+                pass
+
+            def get(self, key):
+                self.calls += 1
+                if self.failing:
+                    raise IOError('connection refused')
+                return 'value'
+
+            def get_mutex(self, key):
+                return 'mutex'
+
+        backend = Backend()
+        stats = RegionStats()
+        proxy = CircuitBreakerProxy(failure_threshold=2, recovery_timeout=0.2,
+                                    stats=stats).wrap(backend)
+
+        self.assertIs(proxy.get('key'), NO_VALUE)
+        self.assertEqual(proxy.state, CircuitBreakerProxy.CLOSED)
+        self.assertIs(proxy.get('key'), NO_VALUE)
+        self.assertEqual(proxy.state, CircuitBreakerProxy.OPEN)
+        self.assertIs(proxy.get('key'), NO_VALUE)
+        self.assertIsNone(proxy.get_mutex('key'))
+        self.assertEqual(backend.calls, 2)
+
+        time.sleep(0.2)
+        self.assertIs(proxy.get('key'), NO_VALUE)
+        self.assertEqual(proxy.state, CircuitBreakerProxy.OPEN)
+        self.assertEqual(backend.calls, 3)
+
+        time.sleep(0.2)
+        backend.failing = False
+        self.assertEqual(proxy.get('key'), 'value')
+        self.assertEqual(proxy.state, CircuitBreakerProxy.CLOSED)
+        self.assertEqual(proxy.get_mutex('key'), 'mutex')
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['breaker_trips'], 2)
+        self.assertEqual(snapshot['breaker_bypasses'], 1)
+
+        proxy = CircuitBreakerProxy(slow_operation_threshold=0).wrap(backend)
+        for _ in range(5):
+            self.assertEqual(proxy.get('key'), 'value')
+        self.assertEqual(proxy.state, CircuitBreakerProxy.OPEN)
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'circuit_breaker': True}
+        cache = DogpileCache(self.app, config)
+        self.assertEqual(cache.stats()['hour']['breaker_state'], 'closed')
+        self.assertTrue(
+            'dogpile_cache_breaker_state{region="hour",state="closed"} 1'
+            in cache.prometheus_metrics()
+        )
+
+        # Shared invalidation and L1 tier degrade with the backend too.
+        config['DOGPILE_CACHE_REGIONS'] = [
+            ('hour', 3600, 'dogpile.cache.memory', [], {}),
+        ]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+            'circuit_breaker': True,
+            'shared_invalidation': True,
+            'invalidation_check_interval': 0,
+            'l1_size': 10,
+        }
+        cache = DogpileCache(self.app, config)
+
+        @cache.region('hour')
+        def func(a):
+            return a
+
+        self.assertEqual(func(1), 1)
+
+        def fail(*args):
+            raise IOError('connection refused')
+
+        actual_backend = cache.get_region('hour').actual_backend
+        for name in ('get', 'get_multi', 'set', 'set_multi', 'delete'):
+            setattr(actual_backend, name, fail)
+        self.assertEqual(func(1), 1)
+        self.assertEqual(func(2), 2)
+        cache.invalidate_region('hour')
+
+    def test_sharded_backend(self):
+        def make_backend(urls, **arguments):
+            arguments.setdefault('hot_key_sample_rate', 0)
+            arguments.update(backend='dogpile.cache.memory', url=urls)
+            return ShardedBackend(arguments)
+
+        backend = make_backend(['a', 'b', 'c'])
+        keys = ['key%d' % i for i in range(1000)]
+        primaries = [backend.get_indexes(key)[0] for key in keys]
+        for index in range(3):
+            self.assertTrue(primaries.count(index) > 200)
+
+        new_backend = make_backend(['a', 'b', 'c', 'd'])
+        moved = sum(
+            new_backend.get_indexes(key)[0] != index
+            for key, index in zip(keys, primaries)
+        )
+        self.assertTrue(moved < 400)
+
+        # Writes of cold keys go to the primary only...
+        for b in backend.backends:
+            b.set('cold', 0)
+        backend.set('cold', 1)
+        values = [b.get('cold') for b in backend.backends]
+        self.assertEqual(sorted(values), [0, 0, 1])
+
+        # ...unless they also clean up replicas.
+        cleaning_backend = make_backend(['a', 'b', 'c'],
+                                        hot_key_cleanup=True)
+        for b in cleaning_backend.backends:
+            b.set('cold', 0)
+        cleaning_backend.set_multi({'cold': 1})
+        values = [b.get('cold') for b in cleaning_backend.backends]
+        self.assertEqual(
+            (values.count(1), values.count(0), values.count(NO_VALUE)),
+            (1, 1, 1),
+        )
+        backend.mark_hot('hot')
+        backend.set_multi({'hot': 2})
+        self.assertEqual(
+            [b.get('hot') for b in backend.backends].count(2), 2
+        )
+        self.assertEqual(backend.get_multi(['cold', 'hot']), [1, 2])
+        backend.delete('hot')
+        self.assertEqual(
+            [b.get('hot') for b in backend.backends].count(NO_VALUE), 3
+        )
+
+        backend = make_backend(['a', 'b'], max_hot_keys=1,
+                               hot_key_sample_rate=1, hot_key_threshold=2)
+        backend.get('key')
+        self.assertFalse(backend.is_hot('key'))
+        backend.get('key')
+        self.assertTrue(backend.is_hot('key'))
+        backend.mark_hot('other')
+        self.assertEqual(backend.hot_keys(), ['other'])
+
+        # Least recently marked keys stop being hot first, without calls to
+        # cache servers. Their replicas are deleted on the next write.
+        backend = make_backend(['a', 'b', 'c'], max_hot_keys=2)
+        deletes = []
+        for b in backend.backends:
+            b.delete = lambda key, delete=b.delete: (
+                deletes.append(key), delete(key)
+            )
+        for key in ['x', 'y', 'z']:
+            backend.mark_hot(key)
+            backend.set(key, 1)
+        for i in range(30):
+            backend.mark_hot(['x', 'y', 'z'][i % 3])
+            backend.get('x')
+        self.assertEqual(deletes, [])
+        backend.mark_hot('y')
+        backend.mark_hot('x')
+        backend.mark_hot('z')
+        self.assertEqual(backend.hot_keys(), ['x', 'z'])
+        backend.set('y', 2)
+        self.assertEqual(deletes, ['y'])
+        self.assertEqual(
+            sorted(b.get('y') for b in backend.backends
+                   if b.get('y') is not NO_VALUE),
+            [2],
+        )
+        backend.set('y', 3)
+        self.assertEqual(deletes, ['y'])
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [
+            ('hour', 3600, 'dogpile.cache.memory', ['a', 'b', 'c']),
+        ]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'sharding': True}
+        cache = DogpileCache(self.app, config)
+
+        @cache.region('hour', hot=True)
+        def func(a):
+            return a
+
+        self.assertEqual(func(1), 1)
+        sharded_backend = cache.get_region('hour').actual_backend
+        self.assertEqual(len(sharded_backend.hot_keys()), 1)
+        self.assertEqual(func(1), 1)
+        cache.invalidate(func, 1)
+        key = sharded_backend.hot_keys()[0]
+        for b in sharded_backend.backends:
+            self.assertIs(b.get(key), NO_VALUE)
+
+    def test_cached_view(self):
+        app = Flask(__name__)
+        cache = DogpileCache(app, deepcopy(self.config))
+        calls = []
+
+        @app.route('/users/<int:user_id>', methods=['GET', 'POST'])
+        @cache.cached_view('hour', vary_on=['Accept-Language'],
+                           query_args=['page'])
+        def user_page(user_id):
+            calls.append(user_id)
+            if user_id == 0:
+                return 'Not found', 404
+            return 'user %s %s' % (user_id, len(calls))
+
+        cache.invalidate_region('hour')
+        client = app.test_client()
+        response = client.get('/users/1?page=2&utm=1')
+        self.assertEqual(response.data, b'user 1 1')
+        self.assertEqual(response.headers['Vary'], 'Accept-Language')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertEqual(client.get('/users/1?utm=2&page=2').data,
+                         b'user 1 1')
+        self.assertEqual(calls, [1])
+
+        response = client.get('/users/1?page=2',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = client.get('/users/1?page=2',
+                              headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        client.get('/users/1?page=2', headers={'Accept-Language': 'uk'})
+        client.post('/users/1?page=2')
+        self.assertEqual(calls, [1, 1, 1])
+
+        client.get('/users/0')
+        client.get('/users/0')
+        self.assertEqual(calls, [1, 1, 1, 0, 0])
+
+        cache.invalidate(user_page, '/users/1', query=(('page', '2'),))
+        self.assertEqual(client.get('/users/1?page=2').data, b'user 1 6')
+
+        self.assertEqual(client.get('/users/2').data, b'user 2 7')
+        self.assertEqual(client.get('/users/2').data, b'user 2 7')
+        self.assertEqual(
+            client.get('/users/2', headers={'Accept-Language': 'uk'}).data,
+            b'user 2 8',
+        )
+        cache.invalidate(user_page, '/users/2')
+        self.assertEqual(client.get('/users/2').data, b'user 2 9')
+        cache.invalidate(user_page, '/users/2', headers=('uk',))
+        self.assertEqual(
+            client.get('/users/2', headers={'Accept-Language': 'uk'}).data,
+            b'user 2 10',
+        )
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'refresh_ahead': 0.1}
+        cache = DogpileCache(app, config)
+        self.assertRaises(ValueError, cache.cached_view, 'hour')
+
+        lazy_cache = DogpileCache()
+        view = lazy_cache.cached_view('hour')(user_page.__wrapped__)
+        lazy_cache.init_app(app, config)
+        with app.test_request_context('/users/1'):
+            self.assertRaises(ValueError, view, user_id=1)
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'serializer': 'json'}
+        cache = DogpileCache(app, config)
+        self.assertRaises(ValueError, cache.cached_view, 'hour')
+
+    def test_cached_view_per_user(self):
+        app = Flask(__name__)
+        app.secret_key = 'secret'
+        cache = DogpileCache(app, deepcopy(self.config))
+
+        @app.route('/login/<user>')
+        def login(user):
+            session['user'] = user
+            return ''
+
+        @app.route('/hello')
+        @cache.cached_view('hour')
+        def hello():
+            return 'hello %s' % session['user']
+
+        @app.route('/agent')
+        @cache.cached_view('hour')
+        def agent():
+            response = make_response(request.user_agent.string)
+            response.vary.add('User-Agent')
+            return response
+
+        cache.invalidate_region('hour')
+        alice = app.test_client()
+        bob = app.test_client()
+        alice.get('/login/alice')
+        bob.get('/login/bob')
+        self.assertEqual(alice.get('/hello').data, b'hello alice')
+        self.assertEqual(bob.get('/hello').data, b'hello bob')
+
+        self.assertEqual(
+            alice.get('/agent', headers={'User-Agent': 'a'}).data, b'a'
+        )
+        self.assertEqual(
+            bob.get('/agent', headers={'User-Agent': 'b'}).data, b'b'
+        )
+
+    def test_chunking(self):
+        cache_dict = dict()
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [
+            ('hour', 3600, 'dogpile.cache.memory', [],
+             {'cache_dict': cache_dict}),
+        ]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+            'chunking': True,
+            'chunk_size': 100,
+        }
+        cache = DogpileCache(self.app, config)
+        calls = []
+
+        @cache.region('hour')
+        def func(size):
+            calls.append(size)
+            return bytes(bytearray(range(256))) * size
+
+        self.assertEqual(func(10), bytes(bytearray(range(256))) * 10)
+        self.assertEqual(func(10), bytes(bytearray(range(256))) * 10)
+        self.assertEqual(func(0), b'')
+        self.assertEqual(calls, [10, 0])
+        self.assertTrue(len(cache_dict) > 25)
+        self.assertTrue(all(len(value) <= 101
+                            for value in cache_dict.values()))
+
+        chunk_key = [key for key in cache_dict if 'chunk' in key][0]
+        cache_dict[chunk_key] = b'x' * 100
+        self.assertEqual(len(func(10)), 2560)
+        self.assertEqual(calls, [10, 0, 10])
+
+        for key in [key for key in cache_dict if 'chunk' in key]:
+            del cache_dict[key]
+        self.assertEqual(len(cache.get_many(func, [(10,), (0,)])[0]), 2560)
+        self.assertEqual(calls, [10, 0, 10, 10])
+
+        cache.invalidate(func, 10)
+        cache.invalidate(func, 0)
+        self.assertEqual(cache_dict, {})
+
+        self.assertRaises(ValueError, ChunkingProxy, 0)
+
+    def test_admission(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+            'admission': {'max_size': 100, 'min_frequency': 2},
+        }
+        cache = DogpileCache(self.app, config)
+        calls = []
+
+        @cache.region('hour')
+        def func(size):
+            calls.append(size)
+            return 'x' * size
+
+        func(10)
+        func(10)
+        func(10)
+        self.assertEqual(calls, [10, 10])
+        func(1000)
+        func(1000)
+        func(1000)
+        self.assertEqual(calls, [10, 10, 1000, 1000, 1000])
+
+        @cache.region('hour', admission={'min_creation_time': 60})
+        def cheap_func(a):
+            calls.append(a)
+            return a
+
+        cheap_func(1)
+        cheap_func(1)
+        self.assertEqual(calls[-2:], [1, 1])
+        cache.refresh(cheap_func, 1)
+        cheap_func(1)
+        self.assertEqual(calls[-3:], [1, 1, 1])
+
+        stats = cache.stats()['hour']
+        self.assertEqual(stats['admissions'], 1)
+        self.assertEqual(stats['rejections_rare'], 1)
+        self.assertEqual(stats['rejections_too_large'], 3)
+        self.assertEqual(stats['rejections_cheap'], 2)
+
+        @cache.region('hour', admission={'max_size': 100})
+        def batch_func(size):
+            calls.append(size)
+            return 'x' * size
+
+        cache.get_many(batch_func, [(20,), (2000,)])
+        cache.get_many(batch_func, [(20,), (2000,)])
+        self.assertEqual(calls[-3:], [20, 2000, 2000])
+        stats = cache.stats()['hour']
+        self.assertEqual(stats['admissions'], 2)
+        self.assertEqual(stats['rejections_too_large'], 5)
+
+        # Values regenerated in background are admitted too.
+        config['DOGPILE_CACHE_REGIONS'] = [('second', 1)]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+            'refresh_ahead': 0.5,
+            'admission': {'max_size': 10},
+        }
+        cache = DogpileCache(self.app, config)
+        sizes = [1]
+
+        @cache.region('second')
+        def refreshed_func():
+            return 'x' * sizes[0]
+
+        cache.invalidate_all_regions()
+        self.assertEqual(refreshed_func(), 'x')
+        sizes[0] = 100
+        time.sleep(0.6)
+        self.assertEqual(refreshed_func(), 'x')
+        cache.shutdown()
+        self.assertEqual(refreshed_func(), 'x')
+        self.assertEqual(cache.stats()['second']['rejections_too_large'], 1)
+
+        config = deepcopy(self.config)
+
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'admission': {'size': 1}}
+        self.assertRaises(ValueError, DogpileCache, self.app, config)
+
+        policy = AdmissionPolicy(min_creation_time=0.1)
+        self.assertEqual(policy(None, 0.01, 0), 'cheap')
+        self.assertEqual(policy(None, 1, 0), None)
+
+        sketch = FrequencySketch(width=16)
+        self.assertEqual(sketch.estimate('a'), 0)
+        for _ in range(20):
+            sketch.increment('a')
+        self.assertEqual(sketch.estimate('a'), 15)
+        for _ in range(140):
+            sketch.increment(None)
+        self.assertTrue(sketch.estimate('a') < 15)
+        self.assertRaises(ValueError, FrequencySketch, 100)
+
+    def test_stats(self):
+        self.clean_up_cache()
+
+        @self.cache.region('hour')
+        def func(a):
+            return a
+
+        func(1)
+        func(1)
+        self.cache.get_many(func, [(1,), (2,)])
+        stats = self.cache.stats()['hour']
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['regenerations'], 2)
+        self.assertTrue(stats['backend_get_seconds']['count'] >= 3)
+        self.assertEqual(stats['backend_set_seconds']['count'], 2)
+
+        self.app.register_blueprint(self.cache.get_stats_blueprint())
+        response = self.app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'dogpile_cache_hits_total{region="hour"} 2',
+                      response.data)
+        self.assertIn(
+            b'dogpile_cache_backend_set_seconds_count{region="hour"} 2',
+            response.data,
+        )
+
+        @self.cache.region('day')
+        def inner_func(a):
+            return a
+
+        @self.cache.region('day')
+        def outer_func(a):
+            return inner_func(a)
+
+        inner_func(1)
+        outer_func(1)
+        stats = self.cache.stats()['day']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+        # Shards of exited threads are folded into the totals.
+        threads = [threading.Thread(target=func, args=(1,))
+                   for _ in range(50)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(self.cache.stats()['hour']['hits'], 52)
+        self.assertTrue(len(self.cache._region_stats['hour']._shards) <= 1)
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_STATS'] = False
+        self.assertEqual(DogpileCache(self.app, config).stats(), {})
+
+    def test_warm(self):
+        self.clean_up_cache()
+        calls = []
+
+        @self.cache.region('hour')
+        def func(a):
+            calls.append(a)
+            return a
+
+        @self.cache.warmer(func)
+        def func_args():
+            return [(i,) for i in range(10)]
+
+        result = self.cache.warm(batch_size=3, concurrency=2)
+        self.assertEqual(result['hour']['values'], 10)
+        self.assertEqual(sorted(calls), list(range(10)))
+        self.assertEqual(func(5), 5)
+        self.assertEqual(len(calls), 10)
+
+        self.assertEqual(self.cache.warm(regions=['day']), {})
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['dogpile-cache', 'warm'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Region `hour`: 10 values', result.output)
+        self.assertEqual(len(calls), 10)
+
+    def test_profile(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [
+            ('hour', 3600, 'dogpile.cache.memory', [], {}),
+            ('day', 3600 * 24, 'dogpile.cache.memory', [], {}),
+        ]
+        config['DOGPILE_CACHE_PROFILE'] = 1
+        cache = DogpileCache(self.app, config)
+
+        @cache.region('hour')
+        def func(a):
+            time.sleep(0.01)
+            return 'x' * a
+
+        for _ in range(4):
+            func(10)
+        cache.invalidate_region('hour')
+        func(10)
+
+        name = 'tests.DogpileCacheTest.test_profile.<locals>.func'
+        report = cache.profile(min_calls=1)
+        self.assertEqual(len(report), 1)
+        item = report[0]
+        self.assertEqual(item['function'], name)
+        self.assertEqual(item['region'], 'hour')
+        self.assertEqual(item['timeout'], 3600)
+        self.assertEqual(item['calls'], 5)
+        self.assertEqual(item['hit_ratio'], 0.6)
+        self.assertEqual(item['expired_miss_ratio'], 0.2)
+        self.assertEqual(item['value_bytes'], 10)
+        self.assertTrue(item['creation_seconds']['p50'] >= 0.01)
+        self.assertTrue(item['saved_seconds'] > 0.02)
+        self.assertEqual(item['suggestions'], [
+            '20% of calls regenerate expired values: move it to region '
+            '`day` (86400s)',
+        ])
+        self.assertEqual(cache.profile()[0]['suggestions'], [])
+        self.assertEqual(self.cache.profile(), [])
+
+        self.app.register_blueprint(cache.get_profile_blueprint())
+        response = self.app.test_client().get('/cache-profile')
+        self.assertEqual(response.get_json()[0]['function'], name)
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            f.write(response.data)
+            f.flush()
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=[
+                'dogpile-cache', 'profile', 'file://' + f.name,
+            ])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn(name + ' (region `hour`, 3600s)', result.output)
+            self.assertIn('hit ratio 60.0%', result.output)
+            result = runner.invoke(args=[
+                'dogpile-cache', 'profile', 'file://' + f.name,
+                '--region', 'day',
+            ])
+            self.assertEqual(result.output, '')
+
+        config['DOGPILE_CACHE_PROFILE'] = 2
+        self.assertRaises(ValueError, DogpileCache, self.app, config)
+
+    def test_invalidate_tag(self):
+        self.clean_up_cache()
+        calls = []
+
+        @self.cache.region('hour', tags=lambda a: ['tag:%s' % a, 'all'])
+        def func(a):
+            calls.append(a)
+            return a
+
+        self.assertEqual([func(1), func(2), func(1), func(2)], [1, 2, 1, 2])
+        self.assertEqual(calls, [1, 2])
+
+        self.cache.invalidate_tag('tag:1')
+        self.assertEqual([func(1), func(2)], [1, 2])
+        self.assertEqual(calls, [1, 2, 1])
+
+        self.cache.invalidate_tag('all')
+        self.assertEqual([func(1), func(2)], [1, 2])
+        self.assertEqual(calls, [1, 2, 1, 1, 2])
+
+        self.cache.set(func, 'custom', 1)
+        self.assertEqual(func(1), 'custom')
+        self.cache.invalidate(func, 1)
+        self.assertEqual(func(1), 1)
+        self.assertEqual(self.cache.get_many(func, [(1,), (2,)]), [1, 2])
+        self.assertEqual(len(calls), 6)
+
+        cache_dict = {}
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [
+            (name, timeout, 'dogpile.cache.memory', [],
+             {'cache_dict': cache_dict})
+            for name, timeout in (('hour', 3600), ('second', 1))
+        ]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'serializer': 'json'}
+        cache = DogpileCache(self.app, config)
+        del calls[:]
+
+        @cache.region('second', tags=lambda a: ['tag:%s' % a])
+        def tagged_func(a):
+            calls.append(a)
+            return a
+
+        # Versions survive json serialization.
+        self.assertEqual([tagged_func(1)] * 3, [1, 1, 1])
+        self.assertEqual(calls, [1])
+
+        # Versions don't expire with the region's values.
+        time.sleep(0.6)
+        cache.set(tagged_func, 'custom', 1)
+        time.sleep(0.6)
+        self.assertEqual(tagged_func(1), 'custom')
+        time.sleep(0.5)
+        self.assertEqual(tagged_func(1), 1)
+        self.assertEqual(calls, [1, 1])
+
+        # Processes which haven't imported tagged funcs invalidate tags.
+        DogpileCache(self.app, dict(config)).invalidate_tag('tag:1')
+        self.assertEqual(tagged_func(1), 1)
+        self.assertEqual(calls, [1, 1, 1])
+
+    def test_shared_invalidation(self):
+        cache_dict = {}
+        config = dict(
+            DOGPILE_CACHE_BACKEND='dogpile.cache.memory',
+            DOGPILE_CACHE_URLS=[],
+            DOGPILE_CACHE_REGIONS=[('hour', 3600, 'dogpile.cache.memory', [],
+                                    {'cache_dict': cache_dict})],
+            DOGPILE_CACHE_REGION_OPTIONS={
+                'shared_invalidation': True,
+                'invalidation_check_interval': 0.1,
+            },
+        )
+        caches = [DogpileCache(Flask(__name__), dict(config))
+                  for _ in range(2)]
+        funcs = []
+        values = [1]
+        for cache in caches:
+            @cache.region('hour')
+            def func():
+                return values[0]
+            funcs.append(func)
+
+        self.assertEqual([func() for func in funcs], [1, 1])
+        values[0] = 2
+        caches[0].invalidate_region('hour')
+        time.sleep(0.15)
+        self.assertEqual(funcs[1](), 2)
+        values[0] = 3
+        self.assertEqual(funcs[0](), 2)
+
+    def test_coroutine_function(self):
+        self.clean_up_cache()
+        calls = []
+
+        @self.cache.region('hour')
+        async def func(a):
+            calls.append(a)
+            await asyncio.sleep(0.01)
+            return [a]
+
+        async def main():
+            values = await asyncio.gather(*[func(1) for _ in range(10)])
+            self.assertEqual(values, [[1]] * 10)
+            self.assertEqual(calls, [1])
+            stats = self.cache.stats()['hour']
+            self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+            self.assertEqual(stats['backend_get_seconds']['count'], 1)
+            self.assertEqual(await func(1), [1])
+
+            await self.cache.set_async(func, 'custom', 1)
+            self.assertEqual(await func(1), 'custom')
+            self.assertEqual(await self.cache.refresh_async(func, 1), [1])
+            self.assertEqual(await func(1), [1])
+            await self.cache.invalidate_async(func, 1)
+            self.assertEqual(await func(1), [1])
+            self.assertEqual(calls, [1, 1, 1])
+
+        asyncio.run(main())
+        self.assertRaises(TypeError, self.cache.refresh, func, 1)
+
+        # Coalesced across event loops of different threads, like async
+        # views of Flask.
+        self.cache.invalidate(func, 2)
+        barrier = threading.Barrier(5)
+        results = []
+
+        def run_in_own_loop():
+            barrier.wait()
+            results.append(asyncio.run(func(2)))
+
+        threads = [threading.Thread(target=run_in_own_loop)
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[2]] * 5)
+        self.assertEqual(calls, [1, 1, 1, 2])
+
+        # Cancelling the first awaiter doesn't cancel the others.
+        self.cache.invalidate(func, 3)
+
+        async def cancel_leader():
+            leader = asyncio.ensure_future(func(3))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(func(3)) for _ in range(3)]
+            while 3 not in calls:
+                await asyncio.sleep(0.001)
+            leader.cancel()
+            self.assertEqual(await asyncio.gather(*followers), [[3]] * 3)
+            self.assertTrue(leader.cancelled())
+
+        asyncio.run(cancel_leader())
+        self.assertEqual(calls.count(3), 2)
+
+        self.assertRaises(TypeError, self.cache.get_many, func, [(1,), (2,)])
+        self.assertRaises(TypeError, self.cache.prefetch, func, [(1,)])
+        self.assertRaises(TypeError, self.cache.warmer, func)
+        self.assertRaises(ValueError, self.cache.region('hour', tags=list),
+                          func)
+
+    def test_single_flight(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'single_flight': True}
+        cache = DogpileCache(self.app, config)
+        calls = []
+
+        @cache.region('hour')
+        def func(a):
+            calls.append(a)
+            time.sleep(0.2)
+            return a
+
+        cache.invalidate_all_regions()
+        threads_count = 100
+        barrier = threading.Barrier(threads_count)
+        results = []
+
+        def call():
+            barrier.wait()
+            results.append(func(1))
+
+        threads = [threading.Thread(target=call)
+                   for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1] * threads_count)
+        self.assertEqual(calls, [1])
+        stats = cache.stats()['hour']
+        self.assertEqual(stats['misses'], 1)
+        self.assertTrue(
+            stats['backend_get_seconds']['count'] < threads_count / 2
+        )
+
+    def test_stale_serving(self):
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGIONS'] = [('second', 1)]
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {
+            'stale_while_revalidate': 60,
+            'stale_if_error': 60,
+        }
+        cache = DogpileCache(self.app, config)
+        calls = []
+        errors = []
+
+        @cache.region('second')
+        def func():
+            if errors:
+                raise errors[0]
+            calls.append(current_app.name)
+            return len(calls)
+
+        cache.invalidate_region('second')
+        with self.app.app_context():
+            self.assertEqual(func(), 1)
+            time.sleep(1.1)
+            self.assertEqual(func(), 1)
+            cache.shutdown()
+            self.assertEqual(func(), 2)
+        self.assertEqual(cache.stats()['second']['stale_hits'], 1)
+
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'stale_if_error': 60}
+        cache = DogpileCache(self.app, config)
+        func = cache.region('second')(func.__wrapped__)
+        cache.invalidate_region('second')
+        with self.app.app_context():
+            value = func()
+            time.sleep(1.1)
+            errors.append(RuntimeError('origin is down'))
+            self.assertEqual(func(), value)
+            self.assertEqual(func(), value)
+            self.assertEqual(cache.stats()['second']['stale_errors'], 2)
+            self.assertRaises(RuntimeError, cache.refresh, func)
+
+            cache.invalidate_region('second')
+            self.assertRaises(RuntimeError, func)
+            errors.pop()
+            self.assertEqual(func(), value + 1)
+
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'stale_if_error': -1}
+        self.assertRaises(ValueError, DogpileCache, self.app, config)
+
+    def test_lazy_regions(self):
+        cache = DogpileCache(self.app, deepcopy(self.config))
+        self.assertEqual(cache._cache_regions, {})
+
+        threads_count = 20
+        barrier = threading.Barrier(threads_count)
+        regions = []
+
+        def get_region():
+            barrier.wait()
+            regions.append(cache.get_region('day'))
+
+        threads = [threading.Thread(target=get_region)
+                   for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(map(id, regions))), 1)
+        self.assertEqual(list(cache._cache_regions), ['day'])
+        self.assertEqual(list(cache.get_all_regions()),
+                         ['hour', 'day', 'week', 'month'])
+        self.assertRaises(KeyError, cache.get_region, 'not_existent')
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = {'refresh_ahead': 2}
+        self.assertRaises(ValueError, DogpileCache, self.app, config)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_fork(self):
+        self.assertEqual(self.func_cached_for_hour(),
+                         self.func_cached_for_hour_value)
+        parent_region = self.cache.get_region('hour')
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                ok = (
+                    self.cache._cache_regions == {}
+                    and self.cache.get_region('hour') is not parent_region
+                    and self.func_cached_for_hour() ==
+                    self.func_cached_for_hour_value
+                )
+            except Exception:
+                ok = False
+            os.write(write_fd, b'1' if ok else b'0')
+            os._exit(0)
+
+        os.close(write_fd)
+        result = os.read(read_fd, 1)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'1')
+        self.assertIs(self.cache.get_region('hour'), parent_region)
+
     def test_cache_with_multiple_arguments(self):
         @self.cache.region('hour')
         def func(a, b):
@@ -157,6 +1270,76 @@ class DogpileCacheTest(unittest.TestCase):
         for a, b in values:
             self.assertEqual(func(a, b), (a, b))
 
+    def test_cache_with_keyword_arguments(self):
+        self.clean_up_cache()
+
+        @self.cache.region('hour')
+        def func(a, b=2, *args, **kwargs):
+            return a, b, args, kwargs
+
+        self.assertEqual(func(1, c=3), (1, 2, (), {'c': 3}))
+        self.cache.set(func, 'custom', a=1, b=2, c=3)
+        self.assertEqual(func(1, c=3), 'custom')
+        self.assertEqual(func(1, 2, c=3), 'custom')
+        self.cache.invalidate(func, 1, c=3)
+        self.assertEqual(func(a=1, c=3), (1, 2, (), {'c': 3}))
+
+    def test_signature_key_generator(self):
+        def func(a, b=2, *args, **kwargs):
+            pass
+
+        key_generator = signature_key_generator(None, func)
+        self.assertEqual(key_generator(1, 2), key_generator(1))
+        self.assertEqual(key_generator(b=2, a=1), key_generator(1))
+        self.assertEqual(key_generator(1, c=1, d=2),
+                         key_generator(1, d=2, c=1))
+        self.assertNotEqual(key_generator(1, 2, 3), key_generator(1, 2))
+
+        key_generator = signature_key_generator(None, func, typed_to_str)
+        self.assertNotEqual(key_generator(1), key_generator('1'))
+
+    def test_typed_to_str(self):
+        @dataclass
+        class Point:
+            x: int
+            y: int
+
+        self.assertNotEqual(typed_to_str(1), typed_to_str('1'))
+        self.assertNotEqual(typed_to_str((1,)), typed_to_str([1]))
+        self.assertEqual(typed_to_str({'a': 1, 'b': {2, 3}}),
+                         typed_to_str({'b': {3, 2}, 'a': 1}))
+        self.assertEqual(typed_to_str(Point(1, 2)), "Point(1,2)")
+
+    def test_key_mangler(self):
+        mangler = KeyMangler()
+        self.assertEqual(mangler('module:func|1 2'),
+                         'module:func|%s' % md5(b'1 2').hexdigest())
+
+        mangler = KeyMangler(algorithm='blake2b', digest_size=8,
+                             max_plain_length=32)
+        self.assertEqual(mangler('module:func|42'), 'module:func|42')
+        self.assertEqual(len(mangler('module:func|4 2')),
+                         len('module:func#') + 16)
+        self.assertEqual(len(mangler('module:func|' + 'x' * 100)),
+                         len('module:func#') + 16)
+
+        long_namespace = 'module:' + 'f' * 1000
+        self.assertTrue(
+            len(mangler(long_namespace + '|1')) <= KeyMangler.MAX_KEY_LENGTH
+        )
+        # Limit is in bytes: 200 chars, but 400 bytes.
+        unicode_namespace = 'module:' + '\u0444' * 200
+        key = mangler(unicode_namespace + '|1')
+        self.assertTrue(
+            len(key.encode('utf-8')) <= KeyMangler.MAX_KEY_LENGTH
+        )
+        self.assertEqual(mangler(unicode_namespace + '|1'), key)
+
+        self.assertRaises(ValueError, KeyMangler, algorithm='not_existent')
+        self.assertRaises(ValueError, KeyMangler, max_plain_length=400)
+        self.assertRaises(ValueError, KeyMangler,
+                          algorithm=lambda data: 'f' * 200)
+
     def test_not_cached_func(self):
         not_cached_func = lambda: None
         self.assertRaises(
@@ -207,6 +1390,14 @@ class DogpileCacheTest(unittest.TestCase):
         config['DOGPILE_CACHE_ARGUMENTS'] = None
         self.assertRaises(ValueError, DogpileCache, app, config)
 
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_REGION_OPTIONS'] = None
+        self.assertRaises(ValueError, DogpileCache, app, config)
+
+        config = deepcopy(self.config)
+        config['DOGPILE_CACHE_KEY_MANGLER'] = 'md5'
+        self.assertRaises(ValueError, DogpileCache, app, config)
+
 
 if __name__ == '__main__':
     unittest.main()